@@ -0,0 +1,153 @@
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from server import Server, parse_args, make_metrics, blocks_on_planner
+from protocol import Decoder, FRAME_TEXT, FRAME_COMMAND
+from clock import make_clock
+from simplify import DEFAULT_EPSILON
+
+
+class ClientConnection:
+    # Исходящие данные клиента. Ответы на команды не теряются никогда,
+    # а очередь обновлений ограничена: при переполнении отбрасываются самые
+    # старые, клиент видит пропуск в seq и сам запрашивает RESYNC.
+    # Обновления кодируются при записи, в текущем режиме протокола клиента
+    def __init__(self, writer, max_queue):
+        self.writer = writer
+        self.mode = 'text'
+        self.subscribed = False
+        self.seq = 0  # Номер ответа на SUBSCRIBE
+        self.replies = deque()
+        self.updates = deque(maxlen=max_queue)
+        self.ready = asyncio.Event()
+        self.dropped = 0
+
+    def push_reply(self, message):
+        self.replies.append(message)
+        self.ready.set()
+
+    def push_update(self, update):
+        if len(self.updates) == self.updates.maxlen:
+            self.dropped += 1
+        self.updates.append(update)
+        self.ready.set()
+
+    async def write_loop(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.replies:
+                self.writer.write(self.replies.popleft())
+            while self.updates:
+                self.writer.write(self.updates.popleft().encoded(self.mode))
+            await self.writer.drain()
+
+
+class AsyncServer(Server):
+    def __init__(self, host='localhost', port=12345, max_queue=256, clock=None,
+                 broadcast_rate=30.0, journal_dir=None, epsilon=DEFAULT_EPSILON, metrics=None):
+        super().__init__(host, port, clock, broadcast_rate, journal_dir, epsilon, metrics)
+        self.max_queue = max_queue  # Максимум неотправленных обновлений на клиента
+        self.connections = set()
+        self.loop = None
+        self.stopped = None
+        self.finished = threading.Event()
+        # Команды, ждущие очереди планировщика, выполняются в своём пуле:
+        # сколько бы их ни стояло, STOP и FLUSH не ждут свободного потока
+        self.planner_executor = ThreadPoolExecutor(thread_name_prefix='planner')
+
+    def register_gauges(self, metrics):
+        super().register_gauges(metrics)
+        # Соединения asyncio учитываются в connections, а не в clients
+        metrics.gauge('laser_clients', lambda: len(self.connections))
+
+    def start(self):
+        print("Сервер запущен (asyncio)...")
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.server_socket.setblocking(False)
+        server = await asyncio.start_server(self.handle_connection, sock=self.server_socket)
+        try:
+            async with server:
+                await self.stopped.wait()
+        finally:
+            self.finished.set()
+
+    async def handle_connection(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        print(f"Подключение от {addr}")
+        connection = ClientConnection(writer, self.max_queue)
+        self.connections.add(connection)
+        writer_task = asyncio.create_task(connection.write_loop())
+        decoder = Decoder()
+        try:
+            while self.running:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                decoder.feed(data)
+                for kind, payload in decoder:
+                    # Команды могут блокироваться (очередь планировщика заполнена),
+                    # поэтому выполняются вне цикла событий
+                    response, mode = await self.loop.run_in_executor(
+                        self.executor_for(kind, payload), self.handle_request,
+                        connection, kind, payload)
+                    connection.push_reply(response)
+                    if mode is not None:
+                        connection.mode = mode
+                        decoder.binary = mode != 'text'
+        except (ConnectionResetError, BrokenPipeError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            pass  # Остановка сервера при открытых соединениях
+        finally:
+            self.connections.discard(connection)
+            writer_task.cancel()
+            writer.close()
+        print(f"Клиент отключен: {addr}")
+
+    def executor_for(self, kind, payload):
+        if kind in (FRAME_TEXT, FRAME_COMMAND) and blocks_on_planner(
+                payload.decode('utf-8', 'replace')):
+            return self.planner_executor
+        return None
+
+    def send_update(self, update):
+        # Вызывается из потока рассылки: только передаёт обновление в цикл
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._fan_out, update)
+
+    def _fan_out(self, update):
+        metrics = self.metrics
+        seq = update.delta['seq']
+        for connection in self.connections:
+            # Обновление могло быть разослано до SUBSCRIBE, а дойти до цикла
+            # после него: снимок его уже содержит
+            if connection.subscribed and seq > connection.seq:
+                connection.push_update(update)
+                if metrics is not None:
+                    # Кодирование кэшируется в Update и при записи не повторяется
+                    self.count_sent(len(update.encoded(connection.mode)))
+
+    def shutdown(self):
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stopped.set)
+            # Вызов из другого потока: слушающий сокет закрывает сам цикл
+            self.finished.wait(timeout=5)
+        super().shutdown()
+        self.planner_executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = AsyncServer(args.host, args.port, clock=make_clock(args.clock),
+                         broadcast_rate=args.rate, journal_dir=args.journal,
+                         epsilon=args.epsilon, metrics=make_metrics(args))
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,303 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import threading
+import time
+from collections import deque
+from server import Server
+from async_server import AsyncServer
+from clock import make_clock
+from metrics import rss_bytes
+from simplify import DEFAULT_EPSILON
+from laser_client import LaserClient
+
+# Нагрузочный тест без графического клиента: сервер запускается в этом же
+# процессе на свободном порту, активные клиенты шлют команды из заданной
+# смеси (до pipeline команд в полёте) и меряют время ответа, слушатели подписываются на обновления и
+# считают принятое. Результат сохраняется в JSON для сравнения между коммитами
+DEFAULT_MIX = 'MOVE=60,LASER=10,SPEED=10,GET_STATUS=20'
+COMMANDS = ('MOVE', 'LASER', 'SPEED', 'GET_STATUS')
+
+
+def parse_mix(spec):
+    # "MOVE=60,GET_STATUS=40" -> команды и веса
+    names = []
+    weights = []
+    for item in spec.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip().upper()
+        if name not in COMMANDS:
+            raise ValueError(f'Неизвестная команда в смеси: {name}')
+        names.append(name)
+        weights.append(float(weight or 1))
+    return names, weights
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def at(fraction):
+        return values[min(int(fraction * len(values)), len(values) - 1)] * 1000.0
+
+    return {'count': len(values), 'mean_ms': sum(values) / len(values) * 1000.0,
+            'p50_ms': at(0.50), 'p90_ms': at(0.90), 'p99_ms': at(0.99),
+            'max_ms': values[-1] * 1000.0}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                              timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class Listener:
+    # Подписчик: обновления считаются в потоке чтения клиента
+    def __init__(self, port, mode):
+        self.deltas = 0
+        self.gaps = 0
+        self.seq = None
+        self.client = LaserClient('127.0.0.1', port, mode, on_event=self.count_delta)
+
+    def count_delta(self, message):
+        if message.get('type') != 'delta':
+            return
+        self.deltas += 1
+        if self.seq is not None and message['seq'] != self.seq + 1:
+            self.gaps += 1
+        self.seq = message['seq']
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.names, self.weights = parse_mix(args.mix)
+        self.stop = threading.Event()
+        self.latencies = {name: [] for name in self.names}
+        self.errors = 0
+        self.results_lock = threading.Lock()
+        self.memory = []
+        self.clients = []
+        self.listeners = []
+        self.server = None
+
+    def start_server(self):
+        args = self.args
+        clock = make_clock(args.clock)
+        if args.server == 'async':
+            self.server = AsyncServer('127.0.0.1', 0, clock=clock, broadcast_rate=args.rate,
+                                      epsilon=args.epsilon)
+        else:
+            self.server = Server('127.0.0.1', 0, clock, args.rate, epsilon=args.epsilon)
+        threading.Thread(target=self.server.start, daemon=True).start()
+        return self.server.server_socket.getsockname()[1]
+
+    def next_command(self, rng, client):
+        name = rng.choices(self.names, self.weights)[0]
+        if name == 'MOVE':
+            # Случайное блуждание, чтобы история росла, а не сжималась упрощением,
+            # в пределах поля станка: за ними сервер обрезает координаты
+            limit = self.server.MAX_COORD
+            client.x = min(max(client.x + rng.uniform(-20, 20), -limit), limit)
+            client.y = min(max(client.y + rng.uniform(-20, 20), -limit), limit)
+            return name, f"MOVE {client.x:.3f} {client.y:.3f}"
+        if name == 'LASER':
+            return name, f"LASER {rng.choice(('ON', 'OFF'))}"
+        if name == 'SPEED':
+            return name, f"SPEED {rng.uniform(50, 500):.1f}"
+        return name, "GET_STATUS"
+
+    def run_active(self, client, seed):
+        rng = random.Random(seed)
+        client.x = client.y = 0.0
+        latencies = {name: [] for name in self.names}
+        errors = 0
+        in_flight = deque()
+        try:
+            while not self.stop.is_set() or in_flight:
+                if not self.stop.is_set() and len(in_flight) < self.args.pipeline:
+                    name, command = self.next_command(rng, client)
+                    in_flight.append((name, time.perf_counter(), client.send(command)))
+                    continue
+                name, started, future = in_flight.popleft()
+                reply = future.result(timeout=30)
+                latencies[name].append(time.perf_counter() - started)
+                if 'error' in reply:
+                    errors += 1
+                if self.args.interval:
+                    time.sleep(self.args.interval)
+        except (OSError, ConnectionError, TimeoutError):
+            errors += 1
+        with self.results_lock:
+            for name, values in latencies.items():
+                self.latencies[name].extend(values)
+            self.errors += errors
+
+    def sample_memory(self):
+        history = self.server.machine.history
+        while True:
+            self.memory.append({'time': time.monotonic() - self.started,
+                                'points': history.point_count,
+                                'strokes': len(history),
+                                'history_bytes': history.nbytes,
+                                'rss_bytes': rss_bytes()})
+            if self.stop.wait(self.args.sample):
+                break
+
+    def run(self):
+        args = self.args
+        port = self.start_server()
+        rss_start = rss_bytes()
+        for _ in range(args.listeners):
+            listener = Listener(port, args.proto)
+            listener.client.subscribe()
+            self.listeners.append(listener)
+        for _ in range(args.clients):
+            self.clients.append(LaserClient('127.0.0.1', port, args.proto))
+
+        self.started = time.monotonic()
+        seq_start = self.server.machine.seq
+        threads = [threading.Thread(target=self.run_active, args=(client, args.seed + i),
+                                    daemon=True)
+                   for i, client in enumerate(self.clients)]
+        sampler = threading.Thread(target=self.sample_memory, daemon=True)
+        for thread in threads:
+            thread.start()
+        sampler.start()
+        time.sleep(args.duration)
+        self.stop.set()
+        for thread in threads:
+            thread.join(timeout=5)
+        sampler.join()
+        elapsed = time.monotonic() - self.started
+        seq_end = self.server.machine.seq
+
+        for client in self.clients + [listener.client for listener in self.listeners]:
+            client.close()
+        self.server.shutdown()
+        return self.report(elapsed, seq_end - seq_start, rss_start)
+
+    def report(self, elapsed, published, rss_start):
+        args = self.args
+        all_latencies = [value for values in self.latencies.values() for value in values]
+        listener_deltas = [client.deltas for client in self.listeners]
+        memory = self.memory
+        growth = None
+        if len(memory) >= 2 and memory[-1]['points'] > memory[0]['points']:
+            points = memory[-1]['points'] - memory[0]['points']
+            growth = {'points': points,
+                      'history_bytes_per_point':
+                          (memory[-1]['history_bytes'] - memory[0]['history_bytes']) / points,
+                      'rss_bytes_per_point':
+                          (memory[-1]['rss_bytes'] - memory[0]['rss_bytes']) / points}
+        return {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': {key: value for key, value in vars(args).items()
+                       if key not in ('output', 'baseline')},
+            'elapsed_s': elapsed,
+            'commands': {
+                'total': len(all_latencies),
+                'per_second': len(all_latencies) / elapsed,
+                'errors': self.errors,
+                'latency': percentiles(all_latencies),
+                'by_command': {name: percentiles(values) for name, values in self.latencies.items()},
+            },
+            'fanout': {
+                'updates_published': published,
+                'updates_per_second': published / elapsed,
+                'deltas_received': sum(listener_deltas),
+                'deltas_per_second': sum(listener_deltas) / elapsed,
+                'seq_gaps': sum(client.gaps for client in self.listeners),
+            },
+            'bytes_per_second': {
+                'listener_received': [listener.client.state.bytes_received / elapsed
+                                      for listener in self.listeners],
+                'client_sent': [client.state.bytes_sent / elapsed for client in self.clients],
+                'client_received': [client.state.bytes_received / elapsed
+                                    for client in self.clients],
+            },
+            'memory': {'rss_start_bytes': rss_start, 'growth': growth, 'samples': memory},
+        }
+
+
+# Показатели для сводки и сравнения: путь в результате, чем меньше - тем лучше
+SUMMARY = (
+    (('commands', 'per_second'), 'команд/с', False),
+    (('commands', 'latency', 'p50_ms'), 'задержка p50, мс', True),
+    (('commands', 'latency', 'p99_ms'), 'задержка p99, мс', True),
+    (('fanout', 'deltas_per_second'), 'обновлений у слушателей/с', False),
+    (('memory', 'growth', 'history_bytes_per_point'), 'байт истории на точку', True),
+    (('memory', 'growth', 'rss_bytes_per_point'), 'байт RSS на точку', True),
+)
+
+
+def lookup(result, path):
+    for key in path:
+        if not isinstance(result, dict) or result.get(key) is None:
+            return None
+        result = result[key]
+    return result
+
+
+def print_summary(result, baseline=None):
+    for path, title, lower_is_better in SUMMARY:
+        value = lookup(result, path)
+        if value is None:
+            continue
+        line = f"{title:>28}: {value:12.3f}"
+        previous = lookup(baseline, path) if baseline else None
+        if previous:
+            change = (value - previous) / previous * 100.0
+            worse = change > 0 if lower_is_better else change < 0
+            line += f"  ({change:+.1f}% к {previous:.3f}{', хуже' if worse else ''})"
+        print(line)
+    print(f"{'ошибок':>28}: {result['commands']['errors']}")
+    print(f"{'пропусков seq':>28}: {result['fanout']['seq_gaps']}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест сервера лазерного станка")
+    parser.add_argument('--server', choices=('threaded', 'async'), default='threaded')
+    parser.add_argument('--clients', type=int, default=8, help="активных клиентов")
+    parser.add_argument('--listeners', type=int, default=8, help="подписчиков на обновления")
+    parser.add_argument('--duration', type=float, default=10.0, help="длительность, с")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="смесь команд с весами")
+    parser.add_argument('--pipeline', type=int, default=1,
+                        help="команд в полёте на клиента (без ожидания ответа)")
+    parser.add_argument('--interval', type=float, default=0.0,
+                        help="пауза между командами клиента, с (0 - без пауз)")
+    parser.add_argument('--proto', choices=('text', 'binary', 'binary32'), default='text')
+    parser.add_argument('--clock', default='virtual',
+                        help="часы станка: real, virtual или ускорение (x10)")
+    parser.add_argument('--rate', type=float, default=30.0, help="частота рассылки, Гц")
+    parser.add_argument('--epsilon', type=float, default=DEFAULT_EPSILON)
+    parser.add_argument('--sample', type=float, default=0.5,
+                        help="период замера памяти, с")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='benchmark.json', help="файл результата")
+    parser.add_argument('--baseline', default=None,
+                        help="прошлый результат для сравнения")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    result = Benchmark(args).run()
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_summary(result, baseline)
+    print(f"Результат сохранён в {args.output}")
@@ -0,0 +1,50 @@
+import threading
+import time
+
+
+class Broadcaster:
+    # Рассылает накопленные изменения с фиксированной частотой, не чаще rate раз
+    # в секунду. Дискретные события (лазер, конец перемещения, CLEAR) уходят
+    # сразу, если с прошлой рассылки прошёл интервал, иначе - в конце интервала,
+    # так что задание из коротких сегментов не повышает частоту обновлений.
+    # Изменения между тиками объединяет VirtualLaserMachine.take_delta
+    def __init__(self, publish, rate=30.0):
+        self.publish = publish
+        self.interval = 1.0 / rate
+        self.dirty = False
+        self.event = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def mark_dirty(self):
+        self.dirty = True
+
+    def notify(self):
+        self.dirty = True
+        self.event.set()
+
+    def run(self):
+        published = 0.0
+        while self.running:
+            self.event.wait(self.interval)
+            self.event.clear()
+            remaining = published + self.interval - time.monotonic()
+            while remaining > 0 and self.running:
+                self.event.wait(remaining)
+                self.event.clear()
+                remaining = published + self.interval - time.monotonic()
+            if self.dirty and self.running:
+                self.dirty = False
+                published = time.monotonic()
+                try:
+                    self.publish()
+                except Exception as e:
+                    # Сбой одной рассылки не должен останавливать поток
+                    print(f"Ошибка рассылки: {e}")
+
+    def shutdown(self):
+        self.running = False
+        self.event.set()
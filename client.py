@@ -1,14 +1,53 @@
 import sys
-import socket
 import json
-import select
-import time
+import threading
+from collections import deque
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-    QLabel, QLineEdit, QPushButton, QFileDialog
+    QLabel, QLineEdit, QPushButton, QFileDialog, QCheckBox
 )
-from PyQt5.QtGui import QImage, QPainter, QPen, QColor, QFont, QPainterPath
-from PyQt5.QtCore import Qt, QTimer, QPoint, QPointF
+from PyQt5.QtGui import QImage, QPixmap, QPainter, QPen, QColor, QFont, QPainterPath
+from PyQt5.QtCore import Qt, QObject, QPoint, QPointF, pyqtSignal
+from raster import qimage_to_array, open_image_bands, stream_paths, ArrayBands
+from contours import trace_paths
+from path_optimizer import optimize_paths, optimize_batches
+from job import paths_to_ops
+from image_stream import JobStreamer, dpi_scale
+from laser_client import LaserClient
+
+
+class StatusReader(QObject):
+    # Мост между потоком чтения LaserClient и GUI. Сообщения копятся до тех
+    # пор, пока GUI их не заберёт: сигнал не повторяется, пока предыдущая
+    # пачка не обработана
+    received = pyqtSignal()
+    disconnected = pyqtSignal()
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.messages = []
+
+    def push(self, message):
+        with self.lock:
+            notify = not self.messages
+            self.messages.append(message)
+        if notify:
+            self.received.emit()
+
+    def push_reply(self, future):
+        # Ответы на команды обрабатываются вместе с рассылкой
+        if future.exception() is None:
+            self.push(future.result())
+
+    def close(self):
+        self.disconnected.emit()
+
+    def take(self):
+        with self.lock:
+            messages, self.messages = self.messages, []
+        return messages
+
 
 class LaserViewer(QWidget):
     def __init__(self, parent=None, main_window=None):
@@ -16,6 +55,7 @@ class LaserViewer(QWidget):
         self.main_window = main_window
         self.setFixedSize(800, 600)
         self.image = QImage(800, 600, QImage.Format_RGB32)
+        self.image_path = None
         self.image.fill(Qt.white)
         self.zoom_level = 1.0
         self.base_grid_step = 50
@@ -26,6 +66,10 @@ class LaserViewer(QWidget):
         self.laser_on = False
         self.history = []
         self.MAX_COORD = 250  # Максимальное значение координат
+        self.LOD_PIXELS = 0.5  # Минимальное расстояние между рисуемыми точками, px
+        self.cache = None      # Сетка и завершённые линии в текущем масштабе
+        self.cache_key = None
+        self.cached_strokes = 0
 
     def wheelEvent(self, event):
         old_zoom = self.zoom_level
@@ -60,11 +104,58 @@ class LaserViewer(QWidget):
     def mouseReleaseEvent(self, event):
         self.drag_start = None
 
-    def paintEvent(self, event):
-        painter = QPainter(self)
+    def invalidate(self):
+        # Слой перерисовывается целиком при следующем paintEvent
+        self.cache = None
+
+    def set_history(self, history):
+        self.history = history
+        self.invalidate()
+
+    def stroke_changed(self, index):
+        # Изменилась уже нарисованная в слое линия
+        if index < self.cached_strokes:
+            self.invalidate()
+
+    def transform(self, painter):
         painter.setRenderHint(QPainter.Antialiasing)
         painter.translate(self.offset)
         painter.scale(self.zoom_level, self.zoom_level)
+
+    def decimate(self, line):
+        # Уровень детализации: точки ближе доли пикселя к предыдущей
+        # не рисуются, при отдалении их отбрасывается больше
+        tolerance = self.LOD_PIXELS / self.zoom_level
+        if tolerance <= 0 or len(line) < 3:
+            return line
+        last_x, last_y = line[0]
+        result = [line[0]]
+        for point in line[1:-1]:
+            if abs(point[0] - last_x) > tolerance or abs(point[1] - last_y) > tolerance:
+                result.append(point)
+                last_x, last_y = point
+        result.append(line[-1])
+        return result
+
+    def draw_line(self, painter, line):
+        if len(line) > 1:
+            line = self.decimate(line)
+            path = QPainterPath()
+            path.moveTo(400 + line[0][0], 300 - line[0][1])
+            for point in line[1:]:
+                path.lineTo(400 + point[0], 300 - point[1])
+            painter.drawPath(path)
+
+    def render_background(self):
+        ratio = self.devicePixelRatioF()
+        self.cache = QPixmap(self.size() * ratio)
+        self.cache.setDevicePixelRatio(ratio)
+        self.cache.fill(self.palette().color(self.backgroundRole()))
+        self.cache_key = (self.zoom_level, self.offset.x(), self.offset.y(), self.size())
+        self.cached_strokes = 0
+
+        painter = QPainter(self.cache)
+        self.transform(painter)
         painter.fillRect(0, 0, 800, 600, Qt.white)
         
         # Сетка
@@ -97,17 +188,36 @@ class LaserViewer(QWidget):
             painter.drawText(x - 15, 315, f"{i*50}")
             y = 300 - i * grid_size
             painter.drawText(415, y + 5, f"{i*50}")
+        painter.end()
+
+    def render_strokes(self, count):
+        # Завершённые линии дорисовываются в слой по одному разу
+        painter = QPainter(self.cache)
+        self.transform(painter)
+        painter.setPen(QPen(Qt.red, 2))
+        for index in range(self.cached_strokes, count):
+            self.draw_line(painter, self.history[index])
+        painter.end()
+        self.cached_strokes = count
 
-        # История линий
-        pen = QPen(Qt.red, 2)
-        painter.setPen(pen)
-        for line in self.history:
-            if len(line) > 1:
-                path = QPainterPath()
-                path.moveTo(400 + line[0][0], 300 - line[0][1])
-                for point in line[1:]:
-                    path.lineTo(400 + point[0], 300 - point[1])
-                painter.drawPath(path)
+    def paintEvent(self, event):
+        # Сетка и завершённые линии берутся из кэша; заново рисуются
+        # только последняя (текущая) линия и позиция станка
+        key = (self.zoom_level, self.offset.x(), self.offset.y(), self.size())
+        if self.cache is None or self.cache_key != key:
+            self.render_background()
+        completed = max(len(self.history) - 1, 0)
+        if self.cached_strokes < completed:
+            self.render_strokes(completed)
+
+        painter = QPainter(self)
+        painter.drawPixmap(0, 0, self.cache)
+        self.transform(painter)
+
+        # Текущая линия
+        if self.history:
+            painter.setPen(QPen(Qt.red, 2))
+            self.draw_line(painter, self.history[-1])
 
         # Текущая позиция
         color = Qt.red if self.laser_on else Qt.blue
@@ -115,31 +225,48 @@ class LaserViewer(QWidget):
         painter.drawPoint(int(400 + self.x), int(300 - self.y))
 
     def load_image(self, image_path):
+        # Уменьшенная копия - только для просмотра и векторного режима,
+        # растровая гравировка читает файл заново полосами
+        self.image_path = image_path
         img = QImage(image_path)
         img = img.scaled(800, 600, Qt.KeepAspectRatio, Qt.SmoothTransformation)
         self.image = img.convertToFormat(QImage.Format_Grayscale8)
         self.update()
 
 class MainWindow(QMainWindow):
+    stream_finished = pyqtSignal(str)
+
     def __init__(self):
         super().__init__()
         self.host = 'localhost'
         self.port = 12345
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.settimeout(1)
-        self.buffer = b""
         self.MAX_COORD = 250  # Максимальное значение координат
-        
+        self.seq = 0                     # Номер последнего применённого обновления
+        self.pending_deltas = {}         # Обновления, пришедшие не по порядку
+        self.applied_deltas = deque(maxlen=256)
+        self.resync_requested = True   # До снимка по SUBSCRIBE пропуски не запрашиваются
+        self.speed = 0.0
+        self.job = None
+        self.optimize_report = None
+        self.merge_gap = 1  # Промежутки до стольких пикселей пропекаются насквозь
+        self.stream_thread = None
+
+        # Обновления с точками идут двоичными кадрами (режим включает клиент
+        # при подключении). Ответ на SUBSCRIBE - снимок, дальше сервер сам
+        # присылает изменения
+        self.reader = StatusReader()
         try:
-            self.socket.connect((self.host, self.port))
-        except (ConnectionRefusedError, socket.timeout):
+            self.client = LaserClient(self.host, self.port, mode='binary',
+                                      on_event=self.reader.push, on_close=self.reader.close)
+        except OSError:
             print("Ошибка подключения к серверу")
             sys.exit(1)
 
         self.init_ui()
-        self.timer = QTimer(self)
-        self.timer.timeout.connect(self.update_status)
-        self.timer.start(50)
+        self.reader.received.connect(self.process_messages)
+        self.reader.disconnected.connect(self.connection_lost)
+        self.stream_finished.connect(self.status_label.setText)
+        self.safe_send("SUBSCRIBE")
 
     def init_ui(self):
         self.setWindowTitle("Лазерный станок - Клиент")
@@ -192,6 +319,24 @@ class MainWindow(QMainWindow):
         load_image_button.clicked.connect(self.load_image)
         control_panel.addWidget(load_image_button)
 
+        self.row_step_input = QLineEdit()
+        self.row_step_input.setPlaceholderText("Шаг строк (пикс)")
+        control_panel.addWidget(self.row_step_input)
+
+        self.dpi_input = QLineEdit()
+        self.dpi_input.setPlaceholderText("Разрешение (DPI)")
+        control_panel.addWidget(self.dpi_input)
+
+        self.serpentine_check = QCheckBox("Сканирование змейкой")
+        control_panel.addWidget(self.serpentine_check)
+
+        self.vector_check = QCheckBox("Векторный режим (контуры)")
+        control_panel.addWidget(self.vector_check)
+
+        self.optimize_check = QCheckBox("Оптимизировать порядок")
+        self.optimize_check.setChecked(True)
+        control_panel.addWidget(self.optimize_check)
+
         scan_image_button = QPushButton("Сканировать изображение")
         scan_image_button.clicked.connect(self.scan_image)
         control_panel.addWidget(scan_image_button)
@@ -218,64 +363,113 @@ class MainWindow(QMainWindow):
         self.safe_send(f"MOVE {x} {y}")
 
     def safe_send(self, command):
-        try:
-            self.socket.sendall(f"{command}\n".encode('utf-8'))
-            return True
-        except (BrokenPipeError, OSError):
+        if self.client.closed:
             self.status_label.setText("Соединение потеряно")
             return False
-
-    def process_buffer(self):
-        while True:
-            msg_end = self.buffer.find(b"\n")
-            if msg_end == -1:
-                break
-
-            full_msg = self.buffer[:msg_end]
-            self.buffer = self.buffer[msg_end+1:]
-
-            try:
-                status = json.loads(full_msg.decode('utf-8'))
-                if 'error' in status:
-                    continue
-                
-                self.viewer.x = status['x']
-                self.viewer.y = status['y']
-                self.viewer.laser_on = status['laser_on']
-                self.viewer.history = status['history']
-                self.laser_button.setText("Выключить лазер" if status['laser_on'] else "Включить лазер")
-                
-                self.status_label.setText(
-                    f"Позиция: ({status['x']:.2f}, {status['y']:.2f})\n"
-                    f"Лазер: {'ВКЛ' if status['laser_on'] else 'ВЫКЛ'}\n"
-                    f"Скорость: {status['speed']} шаг/сек"
-                )
-                self.viewer.update()
-                
-            except json.JSONDecodeError:
+        self.client.send(command, self.reader.push_reply)
+        return True
+
+    def process_messages(self):
+        # Всё накопленное с прошлого вызова применяется разом,
+        # перерисовка - одна на пачку
+        changed = False
+        for status in self.reader.take():
+            if 'error' in status:
                 continue
 
-    def update_status(self):
-        if not self.safe_send("GET_STATUS"):
+            msg_type = status.get('type')
+            if msg_type == 'proto':
+                continue
+            elif msg_type == 'delta':
+                self.apply_delta(status)
+            elif msg_type == 'resync':
+                for delta in status['deltas']:
+                    self.apply_delta(delta)
+                self.resync_requested = False
+            elif 'history' in status:
+                self.apply_snapshot(status)
+            elif status.get('seq', 0) >= self.seq:
+                self.apply_fields(status)
+            changed = True
+
+        if changed:
+            self.refresh_status()
+
+    def apply_fields(self, status):
+        for key in ('x', 'y', 'laser_on'):
+            if key in status:
+                setattr(self.viewer, key, status[key])
+        if 'speed' in status:
+            self.speed = status['speed']
+        if 'job' in status:
+            self.job = status['job']
+
+    def apply_snapshot(self, status):
+        self.apply_fields(status)
+        self.viewer.set_history([list(line) for line in status['history']])
+        # Обновления новее снимка применяются повторно поверх него
+        newer = [delta for delta in self.applied_deltas if delta['seq'] > status['seq']]
+        self.seq = status['seq']
+        self.applied_deltas.clear()
+        for delta in newer:
+            self.pending_deltas.setdefault(delta['seq'], delta)
+        self.pending_deltas = {
+            seq: delta for seq, delta in self.pending_deltas.items() if seq > self.seq
+        }
+        self.resync_requested = False
+        self.drain_deltas()
+
+    def apply_delta(self, delta):
+        if delta['seq'] <= self.seq:
             return
+        self.pending_deltas[delta['seq']] = delta
+        self.drain_deltas()
+
+    def drain_deltas(self):
+        while self.seq + 1 in self.pending_deltas:
+            delta = self.pending_deltas.pop(self.seq + 1)
+            history = self.viewer.history
+            if delta.get('clear'):
+                history.clear()
+                self.viewer.invalidate()
+            for index, offset, points in delta.get('strokes', []):
+                # Сервер может переписать хвост линии начиная с offset
+                if index < len(history):
+                    del history[index][offset:]
+                    history[index].extend(points)
+                    self.viewer.stroke_changed(index)
+                else:
+                    history.append(list(points))
+            self.apply_fields(delta)
+            self.seq = delta['seq']
+            self.applied_deltas.append(delta)
+
+        # Пропуск в нумерации: запрашиваем недостающее у сервера
+        if self.pending_deltas and not self.resync_requested:
+            self.resync_requested = True
+            self.safe_send(f"RESYNC {self.seq}")
+
+    def refresh_status(self):
+        laser_on = self.viewer.laser_on
+        self.laser_button.setText("Выключить лазер" if laser_on else "Включить лазер")
+        text = (
+            f"Позиция: ({self.viewer.x:.2f}, {self.viewer.y:.2f})\n"
+            f"Лазер: {'ВКЛ' if laser_on else 'ВЫКЛ'}\n"
+            f"Скорость: {self.speed} шаг/сек"
+        )
+        if self.job and self.job['total']:
+            text += f"\nЗадание: {self.job['done'] / self.job['total'] * 100:.1f}% ({self.job['state']})"
+        report = self.optimize_report
+        if report:
+            text += (
+                f"\nХолостой ход: {report['travel_before']:.0f} -> {report['travel_after']:.0f}"
+                f" (экономия ~{report['time_saved']:.1f} с)"
+            )
+        self.status_label.setText(text)
+        self.viewer.update()
 
-        try:
-            while True:
-                ready = select.select([self.socket], [], [], 0.01)
-                if not ready[0]:
-                    break
-
-                data = self.socket.recv(4096)
-                if not data:
-                    break
-                self.buffer += data
-
-            self.process_buffer()
-
-        except (socket.timeout, ConnectionResetError):
-            pass
-        except Exception as e:
-            print(f"Ошибка обновления: {e}")
+    def connection_lost(self):
+        self.status_label.setText("Соединение потеряно")
 
     def move_to_coordinates(self):
         x = self.coord_input_x.text()
@@ -306,62 +500,85 @@ class MainWindow(QMainWindow):
             self.viewer.load_image(file_name)
 
     def scan_image(self):
-        if self.viewer.image.isNull():
+        if self.viewer.image_path is None or self.viewer.image.isNull():
             self.status_label.setText("Изображение не загружено")
             return
 
         threshold = 128
-        step_size = 1
-        delay = 0.1
-        width = self.viewer.image.width()
-        height = self.viewer.image.height()
-
-        self.safe_send("MOVE 0 0")
-        self.safe_send("LASER OFF")
-        time.sleep(delay)
-
-        for y in range(0, height, step_size):
-            active_lines = []
-            start_x = None
-
-            for x in range(0, width, step_size):
-                color = self.viewer.image.pixelColor(x, y)
-                brightness = color.red()
-
-                if brightness < threshold:
-                    if start_x is None:
-                        start_x = x
-                else:
-                    if start_x is not None:
-                        active_lines.append((start_x, x - step_size))
-                        start_x = None
-
-            if start_x is not None:
-                active_lines.append((start_x, width - step_size))
-
-            for line in active_lines:
-                start_x, end_x = line
-                # Преобразование координат изображения в системные
-                target_x = start_x - width//2
-                target_y = height//2 - y
-                target_x = max(-self.MAX_COORD, min(target_x, self.MAX_COORD))
-                target_y = max(-self.MAX_COORD, min(target_y, self.MAX_COORD))
-                
-                self.safe_send(f"MOVE {target_x} {target_y}")
-                time.sleep(delay)
-                self.safe_send("LASER ON")
-                time.sleep(delay)
-                self.safe_send(f"MOVE {end_x - width//2} {target_y}")
-                time.sleep(delay)
-                self.safe_send("LASER OFF")
-                time.sleep(delay)
-
-            self.status_label.setText(f"Сканирование: {(y+1)/height*100:.1f}%")
-
-        self.status_label.setText("Сканирование завершено")
+        image = self.viewer.image
+        if self.vector_check.isChecked():
+            # Контуры вместо строк: лазер включается один раз на контур
+            self.send_paths(trace_paths(qimage_to_array(image), threshold))
+            return
+
+        if self.stream_thread is not None and self.stream_thread.is_alive():
+            self.status_label.setText("Изображение ещё загружается")
+            return
+        try:
+            dpi = float(self.dpi_input.text() or 0)
+            row_step = max(1, int(self.row_step_input.text() or 1))
+            source = open_image_bands(self.viewer.image_path)
+        except (OSError, ValueError) as e:
+            self.status_label.setText(f"Ошибка: {e}")
+            return
+        if source is None:
+            # Сжатые форматы декодирует Qt целиком, дальше - те же полосы
+            full = QImage(self.viewer.image_path).convertToFormat(QImage.Format_Grayscale8)
+            if full.isNull():
+                self.status_label.setText("Не удалось прочитать изображение")
+                return
+            source = ArrayBands(qimage_to_array(full))
+
+        # Без DPI изображение занимает столько же, сколько на экране
+        pixel = dpi_scale(dpi) if dpi > 0 else 1.0
+        scale = pixel if dpi > 0 else image.width() / source.width
+        batches = stream_paths(source, threshold, scale, row_step * pixel,
+                               serpentine=self.serpentine_check.isChecked(),
+                               merge_gap=self.merge_gap)
+        self.optimize_report = None
+        if self.optimize_check.isChecked():
+            # Порядок линий улучшается внутри каждой полосы, отчёт растёт
+            # по мере загрузки
+            self.optimize_report = {}
+            batches = optimize_batches(batches, self.optimize_report,
+                                       travel_speed=self.speed or 100.0)
+        self.stream_thread = threading.Thread(target=self.stream_job, args=(source, batches),
+                                              daemon=True)
+        self.stream_thread.start()
+        self.status_label.setText("Задание загружается")
+
+    def stream_job(self, source, batches):
+        # В отдельном потоке: строки уходят на станок по мере чтения файла
+        try:
+            progress = JobStreamer(self.client).run(batches, lambda: self.client.closed)
+            self.stream_finished.emit(f"Задание отправлено: {progress['total']} операций")
+        except (RuntimeError, OSError, ValueError) as e:
+            self.stream_finished.emit(f"Ошибка: {e}")
+        finally:
+            source.close()
+
+    def send_paths(self, paths):
+        report = None
+        if self.optimize_check.isChecked():
+            paths, report = optimize_paths(paths, travel_speed=self.speed or 100.0)
+
+        ops = [["MOVE", 0, 0], ["LASER", "OFF"]]
+        ops.extend(paths_to_ops(paths))
+        self.optimize_report = report
+        self.send_job(ops)
+
+    def send_job(self, ops):
+        # Задание загружается частями и выполняется сервером целиком
+        chunk_size = 1000
+        for i in range(0, len(ops), chunk_size):
+            chunk = json.dumps(ops[i:i + chunk_size], separators=(',', ':'))
+            if not self.safe_send(f"JOB UPLOAD {chunk}"):
+                return
+        self.safe_send("JOB START")
+        self.status_label.setText("Задание отправлено")
 
     def closeEvent(self, event):
-        self.socket.close()
+        self.client.close()
         event.accept()
 
 if __name__ == "__main__":
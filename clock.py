@@ -0,0 +1,55 @@
+import time
+
+
+class RealClock:
+    # Время станка совпадает с реальным
+    analytic = False
+
+    def now(self):
+        return time.monotonic()
+
+    def sleep_until(self, deadline):
+        delay = deadline - self.now()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ScaledClock(RealClock):
+    # Время станка идёт в factor раз быстрее реального
+    def __init__(self, factor):
+        if factor <= 0:
+            raise ValueError(f'Неверный коэффициент ускорения: {factor}')
+        self.factor = factor
+        self.origin = time.monotonic()
+
+    def now(self):
+        return (time.monotonic() - self.origin) * self.factor
+
+    def sleep_until(self, deadline):
+        delay = (deadline - self.now()) / self.factor
+        if delay > 0:
+            time.sleep(delay)
+
+
+class VirtualClock:
+    # Дискретно-событийный режим: ожидание только сдвигает виртуальное время,
+    # а планировщик рассчитывает сегмент целиком без пошагового цикла
+    analytic = True
+
+    def __init__(self):
+        self.time = 0.0
+
+    def now(self):
+        return self.time
+
+    def sleep_until(self, deadline):
+        self.time = max(self.time, deadline)
+
+
+def make_clock(spec):
+    # 'real', 'virtual' или коэффициент ускорения: '10', 'x10'
+    if spec == 'real':
+        return RealClock()
+    if spec == 'virtual':
+        return VirtualClock()
+    return ScaledClock(float(spec.lstrip('x')))
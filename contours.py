@@ -0,0 +1,140 @@
+import numpy as np
+from array import array
+from simplify import simplify_rdp
+
+# Векторный режим: контуры тёмных областей изображения методом marching
+# squares. Ячейка - квадрат из четырёх соседних пикселей, её случай -
+# набор тёмных углов (tl=8, tr=4, br=2, bl=1). Вершины контуров лежат в
+# серединах рёбер между пикселями, отрезки ориентированы так, что тёмная
+# область слева, поэтому в каждую вершину входит ровно один отрезок и
+# ровно один выходит, а контуры замкнуты
+TOP, RIGHT, BOTTOM, LEFT = range(4)
+CORNERS = ((0, 0), (1, 0), (1, 1), (0, 1))               # tl, tr, br, bl как (x, y)
+CORNER_BITS = (8, 4, 2, 1)
+EDGE_POINTS = ((0.5, 0.0), (1.0, 0.5), (0.5, 1.0), (0.0, 0.5))
+CORNER_EDGES = ((TOP, LEFT), (TOP, RIGHT), (RIGHT, BOTTOM), (BOTTOM, LEFT))
+
+
+def _case_segments(case):
+    dark = [bool(case & bit) for bit in CORNER_BITS]
+    count = sum(dark)
+    if count in (0, 4):
+        return []
+    if count in (1, 3):
+        # Отрезается единственный тёмный или единственный светлый угол
+        corner = dark.index(count == 1)
+        pieces = [(CORNER_EDGES[corner], corner if dark[corner] else (corner + 2) % 4)]
+    elif dark[0] == dark[2]:
+        # Седло: тёмные углы по диагонали считаются разделёнными
+        pieces = [(CORNER_EDGES[corner], corner) for corner in range(4) if dark[corner]]
+    else:
+        pieces = [((TOP, BOTTOM) if dark[0] != dark[1] else (LEFT, RIGHT), dark.index(True))]
+
+    segments = []
+    for (a, b), corner in pieces:
+        (ax, ay), (bx, by) = EDGE_POINTS[a], EDGE_POINTS[b]
+        qx, qy = CORNERS[corner]
+        # Ось y изображения направлена вниз: тёмное слева при обходе - это
+        # отрицательное векторное произведение
+        if (bx - ax) * (qy - ay) - (by - ay) * (qx - ax) > 0:
+            a, b = b, a
+        segments.append((a, b))
+    return segments
+
+
+CASE_SEGMENTS = [_case_segments(case) for case in range(16)]
+
+
+def trace_contours(gray, threshold=128):
+    # Замкнутые контуры тёмных (< threshold) областей: список массивов (n, 2)
+    # с координатами x, y в пикселях, первая точка повторена в конце
+    dark = np.zeros((gray.shape[0] + 2, gray.shape[1] + 2), dtype=np.uint8)
+    dark[1:-1, 1:-1] = gray < threshold
+    rows, cols = dark.shape
+    cases = (dark[:-1, :-1] << 3) | (dark[:-1, 1:] << 2) | (dark[1:, 1:] << 1) | dark[1:, :-1]
+
+    # Номер вершины: горизонтальные рёбра сетки углов, затем вертикальные
+    vertical = rows * cols
+
+    def edge_ids(r, c, edge):
+        if edge == TOP:
+            return r * cols + c
+        if edge == BOTTOM:
+            return (r + 1) * cols + c
+        if edge == LEFT:
+            return vertical + r * cols + c
+        return vertical + r * cols + c + 1
+
+    following = np.full(2 * vertical, -1, dtype=np.int64)
+    starts = []
+    for case in range(1, 15):
+        r, c = np.nonzero(cases == case)
+        if not len(r):
+            continue
+        for a, b in CASE_SEGMENTS[case]:
+            start = edge_ids(r, c, a)
+            following[start] = edge_ids(r, c, b)
+            starts.append(start)
+    if not starts:
+        return []
+
+    # Обход циклов по таблице переходов; вершины пройденных контуров гасятся
+    following = following.tolist()
+    contours = []
+    for vertex in np.sort(np.concatenate(starts)).tolist():
+        if following[vertex] < 0:
+            continue
+        loop = [vertex]
+        current = following[vertex]
+        following[vertex] = -1
+        while current != vertex:
+            loop.append(current)
+            following[current], current = -1, following[current]
+        loop.append(vertex)
+        contours.append(_vertex_coords(np.array(loop, dtype=np.int64), cols, vertical))
+    return contours
+
+
+def _vertex_coords(ids, cols, vertical):
+    # Координаты вершин в пикселях исходного изображения (без рамки)
+    is_vertical = ids >= vertical
+    local = np.where(is_vertical, ids - vertical, ids)
+    r, c = np.divmod(local, cols)
+    points = np.empty((len(ids), 2))
+    points[:, 0] = c + np.where(is_vertical, 0.0, 0.5) - 1
+    points[:, 1] = r + np.where(is_vertical, 0.5, 0.0) - 1
+    return points
+
+
+def simplify_contour(points, epsilon):
+    # Ступеньки пиксельной сетки сглаживаются до отрезков с отклонением не
+    # больше epsilon пикселей
+    coords = array('d', points.ravel().tolist())
+    keep = simplify_rdp(coords, 0, len(points), epsilon)
+    return points[keep]
+
+
+def contour_length(points):
+    return float(np.hypot(*np.diff(points, axis=0).T).sum())
+
+
+def contours_to_paths(contours, width, height):
+    # Контуры в системе координат станка с центром в (0, 0), как у растра
+    x_offset = width // 2
+    y_offset = height // 2
+    paths = []
+    for points in contours:
+        paths.append([(x - x_offset, y_offset - y) for x, y in points.tolist()])
+    return paths
+
+
+def trace_paths(gray, threshold=128, epsilon=0.75, min_length=4.0):
+    # Линии для векторной гравировки: контуры, упрощённые и без мелкого шума
+    # (короче min_length пикселей по периметру)
+    height, width = gray.shape
+    contours = []
+    for points in trace_contours(gray, threshold):
+        if contour_length(points) < min_length:
+            continue
+        contours.append(simplify_contour(points, epsilon))
+    return contours_to_paths(contours, width, height)
@@ -0,0 +1,343 @@
+import asyncio
+import json
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pipe, Process
+from async_server import ClientConnection
+from server import Server, make_parser, blocks_on_planner
+from clock import make_clock
+from metrics import Metrics
+from protocol import (
+    Decoder, Update, FRAME_TEXT, FRAME_COMMAND, encode_reply, protocol_mode, split_request_id,
+    tag_reply
+)
+from simplify import DEFAULT_EPSILON
+
+# Парк станков: управляющий процесс принимает клиентов и только
+# маршрутизирует команды и рассылает обновления, а станки распределены по
+# процессам-обработчикам, у каждого свои потоки движения. Команда адресуется
+# станку префиксом "@id" или станку, выбранному командой USE.
+# Сообщения по каналу с обработчиком:
+#   -> (номер запроса, станок, операция, текст); операции: command,
+#      subscribe, unsubscribe; None - завершение
+#   <- ('reply', номер запроса, ответ, подписка оформлена)
+#   <- ('update', станок, обновление)
+
+
+class HostChannel:
+    # Управляющий процесс как единственный клиент станка: обновления
+    # идут, пока на станок подписан хотя бы один клиент
+    def __init__(self):
+        self.subscribed = False
+        self.subscribers = 0
+        self.seq = 0
+
+
+class MachineHost(Server):
+    # Станок внутри процесса-обработчика, без своего сокета
+    def __init__(self, machine_id, send, clock_spec, broadcast_rate, journal_dir, epsilon,
+                 metrics=False):
+        self.machine_id = machine_id
+        self.send = send
+        self.channel = HostChannel()
+        if journal_dir:
+            journal_dir = os.path.join(journal_dir, machine_id)
+        super().__init__(None, None, make_clock(clock_spec), broadcast_rate, journal_dir, epsilon,
+                         Metrics() if metrics else None)
+
+    def bind(self):
+        return None
+
+    def register_gauges(self, metrics):
+        super().register_gauges(metrics)
+        # Клиенты станка парка - подписки через управляющий процесс
+        metrics.gauge('laser_clients', lambda: self.channel.subscribers)
+
+    def send_update(self, update):
+        if self.channel.subscribed:
+            self.send(('update', self.machine_id, update.delta))
+
+    def handle(self, request_id, op, command):
+        channel = self.channel
+        if op == 'subscribe':
+            # Ответ отправляется под той же блокировкой, что и обновления,
+            # поэтому в канале он идёт строго перед обновлением seq + 1
+            with self.broadcast_lock:
+                response = self.process_subscription(channel, command.split())
+                subscribed = 'error' not in json.loads(response)
+                if subscribed:
+                    channel.subscribers += 1
+                channel.subscribed = channel.subscribers > 0
+                self.send(('reply', request_id, response, subscribed))
+            return
+        if op == 'unsubscribe':
+            with self.broadcast_lock:
+                channel.subscribers = max(channel.subscribers - 1, 0)
+                channel.subscribed = channel.subscribers > 0
+            response = json.dumps(self.machine.get_state())
+        else:
+            response = self.process_command(command)
+        if request_id is not None:
+            self.send(('reply', request_id, response, False))
+
+    def shutdown(self):
+        self.stop_machine()
+
+
+def worker_main(conn, machine_ids, options):
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    hosts = {machine_id: MachineHost(machine_id, send, **options) for machine_id in machine_ids}
+    # Команды могут блокироваться (очередь планировщика), поэтому каждая
+    # выполняется в своём потоке, как у однопроцессного сервера. Ждущие
+    # планировщика - в отдельном пуле, чтобы STOP и FLUSH не ждали потока
+    pool = ThreadPoolExecutor(max_workers=max(4, 4 * len(hosts)))
+    planner_pool = ThreadPoolExecutor(max_workers=max(4, 4 * len(hosts)))
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        if message is None:
+            break
+        request_id, machine_id, op, command = message
+        executor = planner_pool if op == 'command' and blocks_on_planner(command) else pool
+        executor.submit(hosts[machine_id].handle, request_id, op, command)
+    for host in hosts.values():
+        host.shutdown()
+    pool.shutdown(wait=False)
+    planner_pool.shutdown(wait=False)
+
+
+class Worker:
+    def __init__(self, machine_ids, options):
+        self.machine_ids = machine_ids
+        self.conn, child = Pipe()
+        self.process = Process(target=worker_main, args=(child, machine_ids, options), daemon=True)
+        self.process.start()
+        child.close()
+
+
+class FleetServer:
+    def __init__(self, host='localhost', port=12345, machine_ids=('m0',), workers=None,
+                 max_queue=256, clock='real', broadcast_rate=30.0, journal_dir=None,
+                 epsilon=DEFAULT_EPSILON, metrics=False):
+        self.host = host
+        self.port = port
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(128)
+        self.machine_ids = list(machine_ids)
+        self.max_queue = max_queue
+        self.running = True
+        self.loop = None
+        self.stopped = None
+        self.finished = threading.Event()
+        self.pending = {}       # Номер запроса -> (соединение, future, станок, метка клиента)
+        self.next_request = 0
+        self.subscribers = {machine_id: set() for machine_id in self.machine_ids}
+
+        options = {'clock_spec': clock, 'broadcast_rate': broadcast_rate,
+                   'journal_dir': journal_dir, 'epsilon': epsilon, 'metrics': metrics}
+        count = max(1, min(workers or os.cpu_count() or 1, len(self.machine_ids)))
+        self.workers = [Worker(self.machine_ids[index::count], options) for index in range(count)]
+        self.route = {machine_id: worker for worker in self.workers
+                      for machine_id in worker.machine_ids}
+
+    def start(self):
+        print(f"Сервер парка запущен: станков {len(self.machine_ids)}, процессов {len(self.workers)}")
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        for worker in self.workers:
+            self.loop.add_reader(worker.conn.fileno(), self.on_worker_message, worker)
+        self.server_socket.setblocking(False)
+        server = await asyncio.start_server(self.handle_connection, sock=self.server_socket)
+        try:
+            async with server:
+                await self.stopped.wait()
+        finally:
+            self.finished.set()
+
+    def on_worker_message(self, worker):
+        conn = worker.conn
+        try:
+            while conn.poll():
+                message = conn.recv()
+                if message[0] == 'update':
+                    _, machine_id, delta = message
+                    subscribers = self.subscribers[machine_id]
+                    if subscribers:
+                        delta['machine'] = machine_id
+                        update = Update(delta)
+                        for connection in subscribers:
+                            connection.push_update(update)
+                    continue
+
+                _, request_id, response, subscribed = message
+                connection, future, machine_id, tag = self.pending.pop(request_id)
+                # Ответ ставится в очередь здесь же, до обработки следующих
+                # обновлений из канала, чтобы клиент получил их после него
+                connection.push_reply(encode_reply(connection.mode, tag_reply(response, tag)))
+                if subscribed:
+                    if connection.closed:
+                        self.send(machine_id, None, 'unsubscribe', '')
+                    else:
+                        self.subscribers[machine_id].add(connection)
+                        connection.subscriptions.add(machine_id)
+                if not future.done():
+                    future.set_result(None)
+        except (EOFError, OSError):
+            self.loop.remove_reader(conn.fileno())
+
+    def send(self, machine_id, request_id, op, command):
+        self.route[machine_id].conn.send((request_id, machine_id, op, command))
+
+    async def request(self, connection, machine_id, op, command, tag=None):
+        future = self.loop.create_future()
+        request_id = self.next_request
+        self.next_request += 1
+        self.pending[request_id] = (connection, future, machine_id, tag)
+        self.send(machine_id, request_id, op, command)
+        await future
+
+    async def handle_connection(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        print(f"Подключение от {addr}")
+        connection = ClientConnection(writer, self.max_queue)
+        connection.machine = self.machine_ids[0]  # Станок для команд без "@id"
+        connection.subscriptions = set()
+        connection.closed = False
+        writer_task = asyncio.create_task(connection.write_loop())
+        decoder = Decoder()
+        try:
+            while self.running:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                decoder.feed(data)
+                for kind, payload in decoder:
+                    await self.handle_request(connection, decoder, kind, payload)
+        except (ConnectionResetError, BrokenPipeError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            pass  # Остановка сервера при открытых соединениях
+        finally:
+            connection.closed = True
+            for machine_id in connection.subscriptions:
+                self.subscribers[machine_id].discard(connection)
+                if self.running:
+                    self.send(machine_id, None, 'unsubscribe', '')
+            writer_task.cancel()
+            writer.close()
+        print(f"Клиент отключен: {addr}")
+
+    def reply(self, connection, response, tag=None):
+        connection.push_reply(encode_reply(connection.mode, tag_reply(json.dumps(response), tag)))
+
+    async def handle_request(self, connection, decoder, kind, payload):
+        if kind not in (FRAME_TEXT, FRAME_COMMAND):
+            self.reply(connection, {'error': 'Неверный кадр'})
+            return
+        tag, command = split_request_id(payload.decode('utf-8').strip())
+        parts = command.split()
+        if not parts:
+            self.reply(connection, {'error': 'Пустая команда'}, tag)
+            return
+
+        machine_id = connection.machine
+        if parts[0].startswith('@'):
+            machine_id = parts[0][1:]
+            command = command[len(parts[0]):].strip()
+            parts = parts[1:]
+            if not parts:
+                self.reply(connection, {'error': 'Пустая команда'}, tag)
+                return
+        if machine_id not in self.route:
+            self.reply(connection, {'error': f'Неизвестный станок: {machine_id}'}, tag)
+            return
+
+        cmd = parts[0].upper()
+        if cmd == 'PROTO':
+            mode = protocol_mode(parts)
+            if mode is None:
+                self.reply(connection, {'error': 'Неверная команда PROTO'}, tag)
+                return
+            self.reply(connection, {'type': 'proto', 'mode': mode}, tag)
+            connection.mode = mode
+            decoder.binary = mode != 'text'
+        elif cmd == 'USE':
+            if len(parts) != 2 or parts[1] not in self.route:
+                self.reply(connection, {'error': 'Неверная команда USE'}, tag)
+                return
+            connection.machine = parts[1]
+            self.reply(connection, {'type': 'machine', 'machine': parts[1]}, tag)
+        elif cmd == 'MACHINES':
+            self.reply(connection, {'type': 'machines', 'machines': self.machine_ids}, tag)
+        elif cmd == 'SUBSCRIBE':
+            if machine_id in connection.subscriptions:
+                # Уже подписан: только снимок или недостающие обновления
+                await self.request(connection, machine_id, 'command',
+                                   'RESYNC ' + ' '.join(parts[1:]), tag)
+            else:
+                await self.request(connection, machine_id, 'subscribe', command, tag)
+        elif cmd == 'UNSUBSCRIBE':
+            if machine_id in connection.subscriptions:
+                connection.subscriptions.discard(machine_id)
+                self.subscribers[machine_id].discard(connection)
+                await self.request(connection, machine_id, 'unsubscribe', command, tag)
+            else:
+                await self.request(connection, machine_id, 'command', 'GET_STATUS', tag)
+        else:
+            await self.request(connection, machine_id, 'command', command, tag)
+
+    def shutdown(self):
+        self.running = False
+        if self.loop is not None and not self.loop.is_closed():
+            # Сначала останавливается приём клиентов, затем обработчики
+            self.loop.call_soon_threadsafe(self.stopped.set)
+            self.finished.wait(timeout=5)
+        for worker in self.workers:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+        for worker in self.workers:
+            worker.process.join(timeout=5)
+        self.server_socket.close()
+        print("Сервер остановлен")
+
+
+def machine_list(spec):
+    # "8" - станки m0..m7, "a,b,c" - станки с указанными именами
+    if spec.isdigit():
+        return [f"m{index}" for index in range(int(spec))]
+    return [name for name in spec.split(',') if name]
+
+
+if __name__ == "__main__":
+    parser = make_parser("Сервер парка виртуальных лазерных станков")
+    parser.add_argument('--machines', default='4',
+                        help="количество станков или их имена через запятую")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="число процессов-обработчиков (по умолчанию - число ядер)")
+    args = parser.parse_args()
+    if args.metrics_port is not None:
+        # Метрики у каждого станка свои, в его процессе: "@id METRICS"
+        parser.error("--metrics-port не поддерживается парком, используйте --metrics")
+    server = FleetServer(args.host, args.port, machine_list(args.machines), args.workers,
+                         clock=args.clock, broadcast_rate=args.rate, journal_dir=args.journal,
+                         epsilon=args.epsilon, metrics=args.metrics)
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        server.shutdown()
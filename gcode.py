@@ -0,0 +1,188 @@
+import json
+import math
+import re
+
+# Слова G-кода: буква и число; комментарии - в скобках и после ';'
+WORD = re.compile(r'([A-Z])\s*([-+]?(?:\d+\.?\d*|\.\d+))')
+COMMENT = re.compile(r'\([^)]*\)|;.*')
+INCH = 25.4
+
+
+class GCodeParser:
+    # Потоковый разбор G-кода в операции станка ('MOVE', x, y), ('LASER', on),
+    # ('SPEED', v). Текст подаётся кусками произвольной длины, в памяти
+    # хранится только незаконченная строка. Поддерживаются G0/G1, дуги G2/G3
+    # (I/J или R, разбиваются на хорды), G20/G21, G90/G91, M3/M4/M5, F.
+    # G0 выполняется с выключенным лазером, G1-G3 - с включённым после M3
+    def __init__(self, position=(0.0, 0.0), arc_tolerance=0.05, max_line=4096):
+        self.x, self.y = position
+        self.arc_tolerance = arc_tolerance
+        self.max_line = max_line
+        self.partial = ''
+        self.absolute = True
+        self.scale = 1.0         # G20 - дюймы, G21 - миллиметры
+        self.motion = None       # Модальная команда движения: 0, 1, 2 или 3
+        self.spindle = False     # M3/M4 включают лазер для рабочих ходов
+        # Состояние лазера после выданных операций. Сначала неизвестно: станок
+        # мог остаться с включённым лазером, поэтому первый же G0 или конец
+        # разбора выключают его явно
+        self.laser_on = None
+        self.lines = 0
+        self.ops = 0
+
+    def feed(self, text):
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        if len(self.partial) > self.max_line:
+            raise ValueError('Слишком длинная строка G-кода')
+        for line in lines:
+            yield from self.parse_line(line)
+
+    def finish(self):
+        # Последняя строка без перевода строки и выключение лазера
+        line, self.partial = self.partial, ''
+        yield from self.parse_line(line)
+        yield from self.set_laser(False)
+
+    def set_laser(self, on):
+        if self.laser_on != on:
+            self.laser_on = on
+            self.ops += 1
+            yield ('LASER', on)
+
+    def move(self, x, y):
+        self.x, self.y = x, y
+        self.ops += 1
+        yield ('MOVE', x, y)
+
+    def parse_line(self, line):
+        self.lines += 1
+        line = COMMENT.sub('', line).upper()
+        words = WORD.findall(line)
+        if not words:
+            return
+        values = {}
+        for letter, number in words:
+            value = float(number)
+            if letter == 'G':
+                if value in (0, 1, 2, 3):
+                    self.motion = int(value)
+                elif value == 20:
+                    self.scale = INCH
+                elif value == 21:
+                    self.scale = 1.0
+                elif value == 90:
+                    self.absolute = True
+                elif value == 91:
+                    self.absolute = False
+            elif letter == 'M':
+                if value in (3, 4):
+                    self.spindle = True
+                elif value in (2, 5, 30):
+                    self.spindle = False
+            else:
+                values[letter] = value
+
+        if 'F' in values and values['F'] > 0:
+            # Подача в единицах в минуту, скорость станка - в секунду
+            self.ops += 1
+            yield ('SPEED', values['F'] * self.scale / 60.0)
+
+        if not self.spindle:
+            yield from self.set_laser(False)
+        if self.motion is None or ('X' not in values and 'Y' not in values):
+            return
+
+        x, y = self.target(values)
+        if self.motion == 0:
+            yield from self.set_laser(False)
+            yield from self.move(x, y)
+            return
+        yield from self.set_laser(self.spindle)
+        if self.motion == 1:
+            yield from self.move(x, y)
+        else:
+            yield from self.arc(x, y, values, clockwise=self.motion == 2)
+
+    def target(self, values):
+        x = values.get('X')
+        y = values.get('Y')
+        if self.absolute:
+            x = self.x if x is None else x * self.scale
+            y = self.y if y is None else y * self.scale
+        else:
+            x = self.x + (x or 0.0) * self.scale
+            y = self.y + (y or 0.0) * self.scale
+        return x, y
+
+    def arc(self, x, y, values, clockwise):
+        start_x, start_y = self.x, self.y
+        if 'R' in values:
+            cx, cy = self.arc_center(x, y, values['R'] * self.scale, clockwise)
+        else:
+            cx = start_x + values.get('I', 0.0) * self.scale
+            cy = start_y + values.get('J', 0.0) * self.scale
+        radius = math.hypot(start_x - cx, start_y - cy)
+        if radius == 0:
+            yield from self.move(x, y)
+            return
+
+        start_angle = math.atan2(start_y - cy, start_x - cx)
+        end_angle = math.atan2(y - cy, x - cx)
+        sweep = end_angle - start_angle
+        if clockwise and sweep >= 0:
+            sweep -= 2 * math.pi
+        elif not clockwise and sweep <= 0:
+            sweep += 2 * math.pi
+
+        # Шаг по углу, при котором хорда отходит от дуги не дальше допуска
+        tolerance = min(self.arc_tolerance, radius)
+        max_step = 2 * math.acos(1 - tolerance / radius)
+        segments = max(1, math.ceil(abs(sweep) / max_step))
+        for i in range(1, segments):
+            angle = start_angle + sweep * i / segments
+            yield from self.move(cx + radius * math.cos(angle), cy + radius * math.sin(angle))
+        yield from self.move(x, y)
+
+    def arc_center(self, x, y, radius, clockwise):
+        # Центр дуги по радиусу; отрицательный R - дуга больше 180°
+        dx = x - self.x
+        dy = y - self.y
+        chord = math.hypot(dx, dy)
+        if chord == 0 or chord > 2 * abs(radius) + 1e-9:
+            raise ValueError('Неверный радиус дуги')
+        offset = math.sqrt(max(radius ** 2 - (chord / 2) ** 2, 0.0))
+        if clockwise != (radius < 0):
+            offset = -offset
+        return (self.x + dx / 2 - dy / chord * offset,
+                self.y + dy / 2 + dx / chord * offset)
+
+
+def gcode_commands(stream, chunk_size=65536):
+    # Команды протокола для загрузки G-кода из текстового потока по частям
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        yield f"GCODE {json.dumps(chunk)}"
+    yield "GCODE END"
+
+
+def export_gcode(offsets, coords, feed=6000.0):
+    # Генератор строк G-кода по истории: переход к началу линии, M3,
+    # рабочие ходы, M5. Текст целиком в памяти не собирается
+    yield "G21"
+    yield "G90"
+    yield f"F{feed:g}"
+    point_count = len(coords) // 2
+    for index in range(len(offsets)):
+        start = offsets[index]
+        end = offsets[index + 1] if index + 1 < len(offsets) else point_count
+        if end <= start:
+            continue
+        yield f"G0 X{coords[2 * start]:.3f} Y{coords[2 * start + 1]:.3f}"
+        yield "M3"
+        for point in range(start + 1, end):
+            yield f"G1 X{coords[2 * point]:.3f} Y{coords[2 * point + 1]:.3f}"
+        yield "M5"
+    yield "M2"
@@ -0,0 +1,129 @@
+import argparse
+import json
+import sys
+import time
+from job import paths_to_ops
+from laser_client import LaserClient
+from raster import open_image_bands, stream_paths
+from path_optimizer import optimize_batches
+
+# Потоковая растровая гравировка: изображение читается полосами строк, линии
+# каждой полосы сразу уходят на станок потоковым заданием (JOB START STREAM),
+# так что память не зависит от размера изображения, а гравировка начинается
+# до обработки всего файла. Запуск без GUI:
+#   python image_stream.py picture.pgm --dpi 254
+
+
+def dpi_scale(dpi):
+    # Размер пикселя в единицах станка (миллиметрах) при заданном разрешении
+    return 25.4 / dpi
+
+
+class JobStreamer:
+    # Загрузка линий на станок частями. Не больше window операций ждут
+    # выполнения на сервере: дальше загрузка ждёт станок
+    def __init__(self, client, chunk_size=1000, window=20000, poll_interval=0.2):
+        self.client = client
+        self.chunk_size = chunk_size
+        self.window = window
+        self.poll_interval = poll_interval
+        self.started = False
+        self.progress = None
+
+    def request(self, command):
+        reply = self.client.request(command)
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        self.progress = reply
+        return reply
+
+    def upload(self, ops):
+        chunk = json.dumps(ops, separators=(',', ':'))
+        self.request(f"JOB UPLOAD {chunk}")
+        if not self.started:
+            self.request("JOB START STREAM")
+            self.started = True
+        while self.progress['total'] - self.progress['done'] > self.window:
+            if self.progress['state'] not in ('running', 'paused'):
+                raise RuntimeError('Задание остановлено')
+            time.sleep(self.poll_interval)
+            self.request("JOB PROGRESS")
+
+    def run(self, batches, cancelled=lambda: False):
+        # batches - списки линий; возвращает последний ответ о ходе задания.
+        # Незапечатанное задание держит станок занятым, поэтому при ошибке
+        # или отмене оно отменяется на сервере
+        sealed = False
+        try:
+            ops = [["MOVE", 0, 0], ["LASER", "OFF"]]
+            for paths in batches:
+                if cancelled():
+                    return self.progress
+                ops.extend(paths_to_ops(paths))
+                while len(ops) >= self.chunk_size:
+                    self.upload(ops[:self.chunk_size])
+                    del ops[:self.chunk_size]
+            if ops and not cancelled():
+                self.upload(ops)
+            if self.started and not cancelled():
+                self.request("JOB SEAL")
+                sealed = True
+        finally:
+            if self.started and not sealed:
+                self.cancel()
+        return self.progress
+
+    def cancel(self):
+        try:
+            self.client.request("JOB CANCEL", timeout=5)
+        except (OSError, TimeoutError):
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Потоковая растровая гравировка изображения")
+    parser.add_argument('image', help="PGM/PPM (P5/P6) или несжатый BMP")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--machine', default=None, help="станок парка (fleet_server)")
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument('--dpi', type=float, default=None, help="разрешение изображения")
+    size.add_argument('--scale', type=float, default=1.0, help="размер пикселя, единиц станка")
+    parser.add_argument('--line-spacing', type=float, default=None,
+                        help="шаг строк гравировки, единиц станка (по умолчанию - пиксель)")
+    parser.add_argument('--threshold', type=int, default=128)
+    parser.add_argument('--serpentine', action='store_true')
+    parser.add_argument('--merge-gap', type=int, default=1)
+    parser.add_argument('--band-rows', type=int, default=256, help="строк изображения в полосе")
+    parser.add_argument('--optimize', action='store_true',
+                        help="оптимизировать порядок линий в каждой полосе")
+    args = parser.parse_args()
+
+    try:
+        source = open_image_bands(args.image)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if source is None:
+        parser.error("Поддерживаются PGM/PPM (P5/P6) и несжатый BMP")
+    scale = dpi_scale(args.dpi) if args.dpi else args.scale
+
+    with LaserClient(args.host, args.port, machine=args.machine) as client:
+        batches = stream_paths(source, args.threshold, scale, args.line_spacing,
+                               args.band_rows, args.serpentine, args.merge_gap)
+        report = {}
+        if args.optimize:
+            batches = optimize_batches(batches, report)
+        try:
+            progress = JobStreamer(client).run(batches)
+        except (RuntimeError, OSError, ValueError) as e:
+            print(f"Ошибка: {e}", file=sys.stderr)
+            sys.exit(1)
+        finally:
+            source.close()
+    print(f"Задание загружено: {progress['total']} операций")
+    if report:
+        print(f"Холостой ход: {report['travel_before']:.0f} -> {report['travel_after']:.0f}")
+
+
+if __name__ == "__main__":
+    main()
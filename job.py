@@ -0,0 +1,89 @@
+import threading
+from collections import deque
+
+# Операция задания и количество её аргументов
+OPERATIONS = {'MOVE': 2, 'LASER': 1, 'SPEED': 1}
+
+
+def parse_ops(data):
+    # [["MOVE", x, y], ["LASER", "ON"], ["SPEED", v], ...] -> список кортежей
+    if not isinstance(data, list):
+        raise ValueError('Задание должно быть списком операций')
+    ops = []
+    for item in data:
+        if not isinstance(item, list) or not item:
+            raise ValueError(f'Неверная операция задания: {item}')
+        name = str(item[0]).upper()
+        if OPERATIONS.get(name) != len(item) - 1:
+            raise ValueError(f'Неверная операция задания: {item}')
+        if name == 'MOVE':
+            ops.append(('MOVE', float(item[1]), float(item[2])))
+        elif name == 'LASER':
+            value = item[1]
+            if isinstance(value, str):
+                value = value.upper() == 'ON'
+            ops.append(('LASER', bool(value)))
+        else:
+            speed = float(item[1])
+            if speed <= 0:
+                raise ValueError(f'Неверная скорость: {speed}')
+            ops.append(('SPEED', speed))
+    return ops
+
+
+class Job:
+    # Операции, ещё не переданные планировщику. Переданные не хранятся, так что
+    # потоковое задание (JOB START STREAM) может дозагружаться во время
+    # выполнения без роста памяти; оно завершается после JOB SEAL
+    def __init__(self):
+        self.ops = deque()
+        self.total = 0       # Всего загружено операций
+        self.index = 0       # Номер следующей операции
+        self.state = 'idle'  # idle, running, paused, done, cancelled
+        self.sealed = True   # Новых операций не будет
+        self.condition = threading.Condition()
+
+    @property
+    def active(self):
+        return self.state in ('running', 'paused')
+
+    def add(self, ops):
+        with self.condition:
+            self.ops.extend(ops)
+            self.total += len(ops)
+            self.condition.notify_all()
+
+    def seal(self):
+        with self.condition:
+            self.sealed = True
+            self.condition.notify_all()
+
+    def cancel(self):
+        with self.condition:
+            self.state = 'cancelled'
+            self.condition.notify_all()
+
+    def next_op(self, stopped):
+        # Следующая операция; None - задание исчерпано или остановлено
+        with self.condition:
+            while not self.ops and not self.sealed and not stopped():
+                self.condition.wait(0.1)
+            if stopped() or not self.ops:
+                return None
+            return self.ops.popleft()
+
+    def progress(self):
+        return {'state': self.state, 'done': self.index, 'total': self.total,
+                'sealed': self.sealed}
+
+
+def paths_to_ops(paths):
+    # Каждая линия: переход с выключенным лазером к началу и проход по точкам
+    ops = []
+    for path in paths:
+        ops.append(["MOVE", path[0][0], path[0][1]])
+        ops.append(["LASER", "ON"])
+        for x, y in path[1:]:
+            ops.append(["MOVE", x, y])
+        ops.append(["LASER", "OFF"])
+    return ops
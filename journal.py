@@ -0,0 +1,244 @@
+import mmap
+import os
+import struct
+import sys
+import threading
+from array import array
+
+# Журнал станка в каталоге: snapshot.bin - полный снимок истории,
+# journal.bin - изменения после него. Поколение в заголовках связывает
+# журнал со снимком: после нового снимка старый журнал не применяется.
+# Записи журнала содержат абсолютные номера линий и точек, поэтому
+# повторное применение записи ничего не портит
+SNAPSHOT_MAGIC = b'LSRS'
+JOURNAL_MAGIC = b'LSRJ'
+VERSION = 1
+
+FILE_HEADER = struct.Struct('<4sIQ')        # сигнатура, версия, поколение
+SNAPSHOT_STATE = struct.Struct('<QQdddB')   # линий, точек, x, y, speed, laser_on
+RECORD = struct.Struct('<BI')               # тип записи, длина
+STATE = struct.Struct('<dddB')              # x, y, speed, laser_on
+START = struct.Struct('<Q')                 # первый номер в записи
+
+RECORD_STATE = 1    # Положение, скорость и лазер
+RECORD_STROKES = 2  # Начала линий: номер первой линии и массив offsets
+RECORD_POINTS = 3   # Точки: номер первой точки и массив coords
+RECORD_CLEAR = 4
+
+
+def _to_bytes(values):
+    # Файлы всегда в little-endian, как и двоичный протокол
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(typecode, data):
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def capture(machine):
+    # Копия истории и состояния; вызывать под блокировкой станка
+    history = machine.history
+    state = (machine.x, machine.y, machine.speed, machine.laser_on)
+    return array('Q', history.offsets), history.coords_slice(0, history.point_count), state
+
+
+def write_snapshot(path, offsets, coords, state, generation=0):
+    # Снимок пишется во временный файл и атомарно подменяет старый
+    temp_path = path + '.tmp'
+    x, y, speed, laser_on = state
+    with open(temp_path, 'wb') as f:
+        f.write(FILE_HEADER.pack(SNAPSHOT_MAGIC, VERSION, generation))
+        f.write(SNAPSHOT_STATE.pack(len(offsets), len(coords) // 2, x, y, speed, laser_on))
+        f.write(_to_bytes(offsets))
+        f.write(_to_bytes(coords))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def read_snapshot(path):
+    # Массивы заполняются прямо из отображённого файла, без списков Python
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, \
+            memoryview(mapped) as data:
+        magic, version, generation = FILE_HEADER.unpack_from(data, 0)
+        if magic != SNAPSHOT_MAGIC or version != VERSION:
+            raise ValueError('Неверный файл снимка')
+        offset = FILE_HEADER.size
+        stroke_count, point_count, x, y, speed, laser_on = SNAPSHOT_STATE.unpack_from(data, offset)
+        offset += SNAPSHOT_STATE.size
+        end = offset + stroke_count * 8
+        offsets = _from_bytes('Q', data[offset:end])
+        offset, end = end, end + point_count * 16
+        coords = _from_bytes('d', data[offset:end])
+        if len(offsets) != stroke_count or len(coords) != point_count * 2:
+            raise ValueError('Файл снимка повреждён')
+    return offsets, coords, (x, y, speed, bool(laser_on)), generation
+
+
+class Journal:
+    # Поток журнала раз в interval секунд забирает под блокировкой станка всё
+    # новое (как take_delta) и дописывает одной пачкой, так что поток движения
+    # не тратит время на запись. Когда журнал вырастает до snapshot_bytes,
+    # делается новый снимок, а журнал начинается заново
+    def __init__(self, directory, machine, lock, interval=0.2, snapshot_bytes=64 << 20):
+        self.directory = directory
+        self.machine = machine
+        self.lock = lock
+        self.interval = interval
+        self.snapshot_bytes = snapshot_bytes
+        self.snapshot_path = os.path.join(directory, 'snapshot.bin')
+        self.journal_path = os.path.join(directory, 'journal.bin')
+        self.write_lock = threading.RLock()
+        self.file = None
+        self.generation = 0
+        self.running = True
+        self.event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.reset_cursor()
+
+    def reset_cursor(self):
+        # Что из состояния станка уже записано
+        machine = self.machine
+        self.clears = machine.clears
+        self.revision = machine.revision
+        self.strokes = len(machine.history)
+        self.points = machine.committed_points
+        self.state = (machine.x, machine.y, machine.speed, machine.laser_on)
+
+    def recover(self):
+        # Восстановление при запуске: снимок, затем хвост журнала
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.snapshot_path):
+            offsets, coords, state, self.generation = read_snapshot(self.snapshot_path)
+            self.machine.restore(offsets, coords, state)
+        valid = self.replay()
+        self.reset_cursor()
+
+        if valid is None:
+            self.open_new()
+        else:
+            # Оборванная последняя запись отрезается
+            self.file = open(self.journal_path, 'r+b')
+            self.file.truncate(valid)
+            self.file.seek(valid)
+        return self.machine.history.point_count
+
+    def replay(self):
+        # Возвращает длину корректной части журнала или None, если журнала
+        # текущего поколения нет
+        if not os.path.exists(self.journal_path) or os.path.getsize(self.journal_path) < FILE_HEADER.size:
+            return None
+        machine = self.machine
+        history = machine.history
+        with open(self.journal_path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, \
+                memoryview(mapped) as data:
+            magic, version, generation = FILE_HEADER.unpack_from(data, 0)
+            if magic != JOURNAL_MAGIC or version != VERSION or generation != self.generation:
+                return None
+            offset = FILE_HEADER.size
+            applied = False
+            while offset + RECORD.size <= len(data):
+                kind, length = RECORD.unpack_from(data, offset)
+                start = offset + RECORD.size
+                end = start + length
+                if end > len(data):
+                    break
+                if kind == RECORD_STATE:
+                    x, y, speed, laser_on = STATE.unpack_from(data, start)
+                    machine.x, machine.y, machine.speed, machine.laser_on = x, y, speed, bool(laser_on)
+                elif kind == RECORD_STROKES:
+                    (first,) = START.unpack_from(data, start)
+                    history.write_offsets(first, _from_bytes('Q', data[start + START.size:end]))
+                elif kind == RECORD_POINTS:
+                    (first,) = START.unpack_from(data, start)
+                    history.write_coords(first, _from_bytes('d', data[start + START.size:end]))
+                elif kind == RECORD_CLEAR:
+                    history.clear()
+                offset = end
+                applied = True
+        if applied:
+            machine.reindex()
+        return offset
+
+    def open_new(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.journal_path, 'wb')
+        self.file.write(FILE_HEADER.pack(JOURNAL_MAGIC, VERSION, self.generation))
+        self.file.flush()
+
+    def start(self):
+        self.thread.start()
+
+    def collect(self):
+        # Вызывается под блокировкой станка
+        machine = self.machine
+        history = machine.history
+        records = []
+        if machine.clears != self.clears:
+            records.append(RECORD.pack(RECORD_CLEAR, 0))
+            self.clears = machine.clears
+            self.strokes = 0
+            self.points = 0
+
+        if machine.revision != self.revision:
+            self.revision = machine.revision
+            stroke_count = len(history)
+            if stroke_count > self.strokes:
+                data = START.pack(self.strokes) + _to_bytes(history.offsets[self.strokes:stroke_count])
+                records.append(RECORD.pack(RECORD_STROKES, len(data)) + data)
+                self.strokes = stroke_count
+
+            # Временная последняя точка пишется каждый раз заново (как в take_delta)
+            point_count = history.point_count
+            if point_count > self.points:
+                data = START.pack(self.points) + _to_bytes(history.coords_slice(self.points, point_count))
+                records.append(RECORD.pack(RECORD_POINTS, len(data)) + data)
+                self.points = machine.committed_points
+
+        state = (machine.x, machine.y, machine.speed, machine.laser_on)
+        if state != self.state:
+            records.append(RECORD.pack(RECORD_STATE, STATE.size) + STATE.pack(*state))
+            self.state = state
+        return records
+
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                records = self.collect()
+            if records:
+                self.file.write(b"".join(records))
+                self.file.flush()
+            if self.file.tell() >= self.snapshot_bytes:
+                self.snapshot()
+
+    def snapshot(self):
+        # Полный снимок нового поколения; всё, что было в журнале, в него входит
+        with self.write_lock:
+            with self.lock:
+                offsets, coords, state = capture(self.machine)
+                self.reset_cursor()
+            self.generation += 1
+            write_snapshot(self.snapshot_path, offsets, coords, state, self.generation)
+            self.open_new()
+
+    def run(self):
+        while self.running:
+            self.event.wait(self.interval)
+            self.flush()
+
+    def shutdown(self):
+        self.running = False
+        self.event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.flush()
+        self.file.close()
@@ -0,0 +1,231 @@
+import asyncio
+import queue
+import socket
+import threading
+from concurrent.futures import Future
+from protocol import Decoder, decode_message, encode_command, protocol_mode
+
+# Клиент протокола станка без GUI, синхронный (поток чтения) и asyncio.
+# Каждая команда отправляется с меткой "#id", ответ с тем же id завершает
+# её future, поэтому команд в полёте может быть сколько угодно. Сообщения
+# без id - обновления рассылки и прочие события - передаются отдельно:
+# в on_event или в очередь events. С machine команды адресуются станку
+# парка (fleet_server): к каждой добавляется "@machine"
+
+
+class ProtocolState:
+    # Общая часть обоих клиентов: метки запросов, разбор входящего потока
+    # и разделение ответов и событий
+    def __init__(self, machine=None):
+        self.prefix = f"#{{}} @{machine} " if machine else "#{} "
+        # Снимки и обновления после LOAD могут быть очень большими
+        self.decoder = Decoder(max_message=None)
+        self.mode = 'text'
+        self.pending = {}  # id -> future
+        self.next_id = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def encode(self, command):
+        # Метка и кадр новой команды; future регистрирует вызывающий
+        request_id = str(self.next_id)
+        self.next_id += 1
+        data = encode_command(self.mode, self.prefix.format(request_id) + command)
+        self.bytes_sent += len(data)
+        if command.split(None, 1)[0].upper() == 'PROTO':
+            # Следующие команды сервер читает уже в новом режиме; неверный
+            # PROTO сервер отклоняет, не меняя режим
+            self.mode = protocol_mode(command.split()) or self.mode
+        return request_id, data
+
+    def feed(self, data):
+        # Пары (future или None, сообщение) по порядку прихода
+        self.bytes_received += len(data)
+        self.decoder.feed(data)
+        for kind, payload in self.decoder:
+            message = decode_message(kind, payload)
+            if message.get('type') == 'proto':
+                # Режим разбора меняется сразу после ответа на PROTO
+                self.decoder.binary = message['mode'] != 'text'
+            request_id = message.pop('id', None)
+            yield self.pending.pop(request_id, None) if request_id is not None else None, message
+
+
+class LaserClient:
+    def __init__(self, host='localhost', port=12345, mode='binary', on_event=None,
+                 on_close=None, timeout=5.0, machine=None):
+        self.socket = socket.create_connection((host, port), timeout=timeout)
+        self.socket.settimeout(None)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.state = ProtocolState(machine)
+        # Порядок отправки важен только для PROTO; ожидающие ответа - под
+        # отдельной блокировкой, чтобы поток чтения не ждал занятый sendall
+        self.send_lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+        self.on_event = on_event
+        self.on_close = on_close
+        self.events = queue.Queue()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        if mode != 'text':
+            self.request('PROTO BINARY F32' if mode == 'binary32' else 'PROTO BINARY', timeout)
+
+    @property
+    def mode(self):
+        return self.state.mode
+
+    def send(self, command, callback=None):
+        # Отправка без ожидания ответа; ответ - в возвращаемом Future.
+        # callback(future) вызывается в потоке чтения строго по порядку
+        # прихода сообщений, вперемешку с on_event
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+        with self.send_lock:
+            with self.pending_lock:
+                if self.closed:
+                    future.set_exception(ConnectionError('Соединение закрыто'))
+                    return future
+                request_id, data = self.state.encode(command)
+                self.state.pending[request_id] = future
+            try:
+                self.socket.sendall(data)
+            except OSError as e:
+                with self.pending_lock:
+                    self.state.pending.pop(request_id, None)
+                if not future.done():
+                    future.set_exception(ConnectionError(str(e)))
+        return future
+
+    def request(self, command, timeout=None):
+        return self.send(command).result(timeout)
+
+    def move(self, x, y):
+        return self.request(f"MOVE {x} {y}")
+
+    def laser(self, on):
+        return self.request(f"LASER {'ON' if on else 'OFF'}")
+
+    def speed(self, value):
+        return self.request(f"SPEED {value}")
+
+    def status(self):
+        return self.request("GET_STATUS")
+
+    def subscribe(self, since=None):
+        return self.request("SUBSCRIBE" if since is None else f"SUBSCRIBE {since}")
+
+    def run(self):
+        try:
+            while True:
+                data = self.socket.recv(1 << 20)
+                if not data:
+                    break
+                with self.pending_lock:
+                    messages = list(self.state.feed(data))
+                for future, message in messages:
+                    if future is not None:
+                        future.set_result(message)
+                    elif self.on_event is not None:
+                        self.on_event(message)
+                    else:
+                        self.events.put(message)
+        except (OSError, ValueError):
+            pass
+        with self.pending_lock:
+            self.closed = True
+            pending, self.state.pending = self.state.pending, {}
+        for future in pending.values():
+            future.set_exception(ConnectionError('Соединение закрыто'))
+        self.events.put(None)
+        if self.on_close is not None:
+            self.on_close()
+
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        if threading.current_thread() is not self.thread:
+            self.thread.join(timeout=5)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncLaserClient:
+    # То же для asyncio: connect() - сопрограмма, send() возвращает
+    # asyncio.Future, события - в on_event или в очереди events
+    def __init__(self, reader, writer, on_event=None, machine=None):
+        self.reader = reader
+        self.writer = writer
+        self.state = ProtocolState(machine)
+        self.on_event = on_event
+        self.events = asyncio.Queue()
+        self.closed = False
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    @classmethod
+    async def connect(cls, host='localhost', port=12345, mode='binary', on_event=None,
+                      machine=None):
+        reader, writer = await asyncio.open_connection(host, port)
+        client = cls(reader, writer, on_event, machine)
+        if mode != 'text':
+            await client.request('PROTO BINARY F32' if mode == 'binary32' else 'PROTO BINARY')
+        return client
+
+    @property
+    def mode(self):
+        return self.state.mode
+
+    def send(self, command):
+        future = asyncio.get_running_loop().create_future()
+        if self.closed:
+            future.set_exception(ConnectionError('Соединение закрыто'))
+            return future
+        request_id, data = self.state.encode(command)
+        self.state.pending[request_id] = future
+        self.writer.write(data)
+        return future
+
+    async def request(self, command):
+        future = self.send(command)
+        await self.writer.drain()
+        return await future
+
+    async def run(self):
+        try:
+            while True:
+                data = await self.reader.read(1 << 20)
+                if not data:
+                    break
+                for future, message in self.state.feed(data):
+                    if future is not None:
+                        if not future.done():
+                            future.set_result(message)
+                    elif self.on_event is not None:
+                        self.on_event(message)
+                    else:
+                        self.events.put_nowait(message)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.closed = True
+            pending, self.state.pending = self.state.pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('Соединение закрыто'))
+            self.events.put_nowait(None)
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+        self.task.cancel()
@@ -0,0 +1,203 @@
+import bisect
+import os
+import resource
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Встроенные метрики сервера: счётчики, гистограммы с фиксированными
+# границами и показатели, вычисляемые при чтении. Выключенные метрики -
+# это metrics = None у сервера: в горячих местах остаётся одна проверка
+TIME_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def rss_bytes():
+    # Текущий размер резидентной памяти; без /proc - пиковый
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Последняя - больше всех границ
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, fraction):
+        # Оценка по верхней границе корзины
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+        if not count:
+            return None
+        rank = fraction * count
+        total = 0
+        for index, bucket_count in enumerate(counts):
+            total += bucket_count
+            if total >= rank and bucket_count:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return None
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}    # (имя, метки) -> значение
+        self.histograms = {}  # (имя, метки) -> Histogram
+        self.gauges = {}      # имя -> функция без аргументов
+        self.started = time.monotonic()
+        self.http = None
+
+    def inc(self, name, value=1, labels=()):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def histogram(self, name, labels=(), buckets=TIME_BUCKETS):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram(buckets))
+        return histogram
+
+    def observe(self, name, value, labels=(), buckets=TIME_BUCKETS):
+        self.histogram(name, labels, buckets).observe(value)
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def collect_gauges(self):
+        values = {'laser_uptime_seconds': time.monotonic() - self.started,
+                  'laser_process_resident_bytes': rss_bytes()}
+        for name, function in self.gauges.items():
+            values[name] = function()
+        return values
+
+    def as_dict(self):
+        # Ответ на команду METRICS
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict(self.histograms)
+        return {
+            'type': 'metrics',
+            'gauges': self.collect_gauges(),
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                         for (name, labels), value in sorted(counters.items())],
+            'histograms': [{'name': name, 'labels': dict(labels), 'count': histogram.count,
+                            'sum': histogram.sum, 'p50': histogram.quantile(0.5),
+                            'p99': histogram.quantile(0.99)}
+                           for (name, labels), histogram in sorted(histograms.items())],
+        }
+
+    def render_text(self):
+        # Текстовый формат Prometheus
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict(self.histograms)
+        lines = []
+        for name, value in self.collect_gauges().items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        typed = set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            with histogram.lock:
+                counts = list(histogram.counts)
+                total, count = histogram.sum, histogram.count
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                bucket_labels = labels + (('le', bound),)
+                lines.append(f"{name}_bucket{format_labels(bucket_labels)} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host, port):
+        # HTTP-слушатель для сборщика метрик, в отдельном потоке
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.http = ThreadingHTTPServer((host, port), Handler)
+        self.http.daemon_threads = True
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+        return self.http.server_address[1]
+
+    def shutdown(self):
+        if self.http is not None:
+            self.http.shutdown()
+            self.http.server_close()
+            self.http = None
+
+
+class TimedLock:
+    # Блокировка, замеряющая время ожидания захвата. Ставится вместо
+    # threading.Lock только при включённых метриках
+    def __init__(self, histogram):
+        self.lock = threading.Lock()
+        self.histogram = histogram
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.lock.acquire(False):
+            self.histogram.observe(0.0)
+            return True
+        if not blocking:
+            return False
+        started = time.perf_counter()
+        acquired = self.lock.acquire(True, timeout)
+        self.histogram.observe(time.perf_counter() - started)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
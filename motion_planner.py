@@ -0,0 +1,291 @@
+import math
+import threading
+from collections import deque
+from itertools import islice
+from clock import RealClock
+
+
+class Segment:
+    # Элемент очереди планировщика. Команды LASER и SPEED ставятся в очередь
+    # как сегменты нулевой длины, чтобы выполняться строго по порядку
+    def __init__(self, x, y, laser_on, speed, start=None, callback=None):
+        self.x = x
+        self.y = y
+        self.laser_on = laser_on
+        self.speed = speed
+        self.callback = callback
+        self.length = 0.0
+        self.ux = 0.0
+        self.uy = 0.0
+        if start is not None:
+            dx = x - start[0]
+            dy = y - start[1]
+            self.length = math.hypot(dx, dy)
+            if self.length > 0:
+                self.ux = dx / self.length
+                self.uy = dy / self.length
+        self.junction_speed = 0.0  # Предельная скорость на входе в сегмент
+        self.exit_speed = 0.0      # Скорость на выходе по текущему плану
+
+
+class MotionPlanner:
+    def __init__(self, machine, lock, on_step, on_event, acceleration=2000.0,
+                 junction_deviation=0.1, lookahead=32, max_queue=256, clock=None):
+        self.machine = machine
+        self.clock = clock or RealClock()
+        self.lock = lock                  # Защищает изменение состояния станка
+        self.on_step = on_step            # Вызывается после каждого шага
+        self.on_event = on_event          # Смена лазера/скорости, конец перемещения
+        self.acceleration = acceleration  # Единиц/с²
+        self.junction_deviation = junction_deviation
+        self.lookahead = lookahead        # Сколько сегментов вперёд планировать
+        self.max_queue = max_queue
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.running = True
+        self.held = False
+        self.aborted = False
+        self.current = None
+        self.velocity = 0.0    # Скорость в конце последнего сегмента
+        self.stroke_open = False
+        self.tail = None       # Состояние станка после всех сегментов очереди
+        self.tail_move = None  # Последний сегмент движения в очереди
+        self.metrics = None    # Metrics сервера, если включены
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, op, callback=None):
+        # op: ('MOVE', x, y), ('LASER', on) или ('SPEED', v).
+        # Блокируется, пока очередь заполнена
+        with self.condition:
+            while self.running and len(self.queue) >= self.max_queue:
+                self.condition.wait()
+            if not self.running:
+                return
+
+            if not self.queue:
+                self.tail = (self.machine.x, self.machine.y,
+                             self.machine.laser_on, self.machine.speed)
+                self.tail_move = None
+            x, y, laser_on, speed = self.tail
+
+            if op[0] == 'MOVE':
+                segment = Segment(op[1], op[2], laser_on, speed, (x, y), callback)
+                if segment.length > 0:
+                    segment.junction_speed = self.junction_speed(self.tail_move, segment)
+                    self.tail_move = segment
+                x, y = op[1], op[2]
+            elif op[0] == 'LASER':
+                laser_on = op[1]
+                segment = Segment(x, y, laser_on, speed, callback=callback)
+            else:
+                speed = op[1]
+                segment = Segment(x, y, laser_on, speed, callback=callback)
+
+            self.tail = (x, y, laser_on, speed)
+            self.queue.append(segment)
+            self.replan()
+            self.condition.notify_all()
+
+    def position(self):
+        # Где окажется станок после всех сегментов очереди
+        with self.condition:
+            if self.queue:
+                return self.tail[0], self.tail[1]
+            return self.machine.x, self.machine.y
+
+    def junction_speed(self, prev, segment):
+        # Скорость прохождения стыка двух сегментов по отклонению от угла
+        if prev is None:
+            return 0.0
+        limit = min(prev.speed, segment.speed)
+        cos_theta = -(prev.ux * segment.ux + prev.uy * segment.uy)
+        if cos_theta > 0.999999:
+            return 0.0
+        if cos_theta < -0.999999:
+            return limit
+        sin_half = math.sqrt(0.5 * (1.0 - cos_theta))
+        speed = math.sqrt(self.acceleration * self.junction_deviation
+                          * sin_half / (1.0 - sin_half))
+        return min(speed, limit)
+
+    def replan(self):
+        # Обратный проход: скорости входа, с которых можно остановиться
+        # к концу очереди. Прямой проход выполняется при движении
+        if not self.queue:
+            return
+        moves = [segment for segment in islice(self.queue, 1, None) if segment.length > 0]
+        next_entry = 0.0
+        for segment in reversed(moves[:self.lookahead]):
+            segment.exit_speed = next_entry
+            next_entry = min(segment.junction_speed,
+                             math.sqrt(next_entry ** 2 + 2 * self.acceleration * segment.length))
+        head = self.queue[0]
+        if head.length > 0:
+            head.exit_speed = next_entry
+
+    def speed_at(self, s, length, entry, exit_speed, nominal):
+        a2 = 2 * self.acceleration
+        return min(nominal,
+                   math.sqrt(entry ** 2 + a2 * s),
+                   math.sqrt(exit_speed ** 2 + a2 * max(length - s, 0.0)))
+
+    def profile_time(self, length, entry, exit_speed, nominal):
+        # Время прохождения трапециевидного профиля скорости
+        a = self.acceleration
+        entry = min(entry, nominal, math.sqrt(exit_speed ** 2 + 2 * a * length))
+        exit_speed = min(exit_speed, nominal, math.sqrt(entry ** 2 + 2 * a * length))
+        peak = min(nominal, math.sqrt((2 * a * length + entry ** 2 + exit_speed ** 2) / 2))
+        accel_distance = (peak ** 2 - entry ** 2) / (2 * a)
+        decel_distance = (peak ** 2 - exit_speed ** 2) / (2 * a)
+        cruise = max(length - accel_distance - decel_distance, 0.0)
+        return (peak - entry) / a + (peak - exit_speed) / a + cruise / peak
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and (not self.queue or self.held):
+                    self.velocity = 0.0
+                    self.condition.wait()
+                if not self.running:
+                    return
+                segment = self.queue[0]
+                self.current = segment
+                self.aborted = False
+                self.replan()
+
+            finished = self.execute(segment)
+
+            with self.condition:
+                self.current = None
+                if finished and self.queue and self.queue[0] is segment:
+                    self.queue.popleft()
+                else:
+                    finished = False
+                self.condition.notify_all()
+            if finished and segment.callback:
+                segment.callback()
+
+    def execute(self, segment):
+        machine = self.machine
+        with self.lock:
+            machine.laser_on = segment.laser_on
+            machine.speed = segment.speed
+            if not segment.laser_on:
+                self.stroke_open = False
+            start_x = machine.x
+            start_y = machine.y
+
+        dx = segment.x - start_x
+        dy = segment.y - start_y
+        length = math.hypot(dx, dy)
+        if length == 0:
+            self.on_event()
+            return True
+
+        steps = max(1, int(round(length)))
+        ds = length / steps
+        step_x = dx / steps
+        step_y = dy / steps
+        entry = min(self.velocity, segment.speed)
+
+        if segment.laser_on and not self.stroke_open:
+            with self.lock:
+                machine.begin_stroke(start_x, start_y)
+            self.stroke_open = True
+
+        if self.clock.analytic:
+            return self.execute_analytic(segment, start_x, start_y, steps, step_x, step_y,
+                                         length, entry)
+
+        metrics = self.metrics
+        deadline = self.clock.now()
+        for i in range(steps):
+            if not self.running or self.aborted or self.held:
+                self.velocity = 0.0
+                return False
+
+            speed = self.speed_at(ds * (i + 0.5), length, entry,
+                                  segment.exit_speed, segment.speed)
+            with self.lock:
+                machine.x = start_x + step_x * (i + 1)
+                machine.y = start_y + step_y * (i + 1)
+                if segment.laser_on:
+                    machine.add_point(machine.x, machine.y)
+            self.on_step()
+
+            deadline += ds / speed
+            self.clock.sleep_until(deadline)
+            if metrics is not None:
+                # Опоздание шага относительно расчётного интервала ds / speed
+                metrics.observe('laser_step_lateness_seconds', self.clock.now() - deadline)
+
+        self.velocity = self.speed_at(length, length, entry, segment.exit_speed, segment.speed)
+        self.on_event()
+        return True
+
+    def execute_analytic(self, segment, start_x, start_y, steps, step_x, step_y, length, entry):
+        # Те же точки, что и при пошаговом движении, но сразу на весь сегмент
+        machine = self.machine
+        with self.lock:
+            if segment.laser_on:
+                coords = []
+                for i in range(1, steps + 1):
+                    coords.append(start_x + step_x * i)
+                    coords.append(start_y + step_y * i)
+                machine.add_points(coords)
+            machine.x = start_x + step_x * steps
+            machine.y = start_y + step_y * steps
+        self.on_event()
+
+        exit_speed = segment.exit_speed
+        self.clock.sleep_until(self.clock.now()
+                               + self.profile_time(length, entry, exit_speed, segment.speed))
+        self.velocity = self.speed_at(length, length, entry, exit_speed, segment.speed)
+        return True
+
+    def hold(self):
+        # Пауза: станок останавливается, текущий сегмент продолжится после release
+        with self.condition:
+            self.held = True
+
+    def release(self):
+        with self.condition:
+            self.held = False
+            self.condition.notify_all()
+
+    def flush(self):
+        # Отбросить очередь, дав текущему сегменту завершиться с остановкой
+        with self.condition:
+            while len(self.queue) > 1 or (self.queue and self.queue[0] is not self.current):
+                self.queue.pop()
+            if self.queue:
+                head = self.queue[0]
+                head.exit_speed = 0.0
+                self.tail = (head.x, head.y, head.laser_on, head.speed)
+                self.tail_move = head if head.length > 0 else None
+            self.condition.notify_all()
+
+    def stop(self):
+        # Немедленная остановка с очисткой очереди
+        with self.condition:
+            self.queue.clear()
+            self.aborted = True
+            self.held = False
+            self.condition.notify_all()
+
+    @property
+    def idle(self):
+        return not self.queue and self.current is None
+
+    def wait_idle(self, cancelled=lambda: False):
+        with self.condition:
+            while self.running and not self.idle and not cancelled():
+                self.condition.wait(0.1)
+
+    def shutdown(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
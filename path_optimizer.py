@@ -0,0 +1,273 @@
+import math
+import time
+from array import array
+import numpy as np
+from spatial_index import SpatialIndex
+
+
+def travel_length(paths, start=(0.0, 0.0)):
+    # Суммарная длина холостых переходов при обходе линий в заданном порядке
+    total = 0.0
+    x, y = start
+    for path in paths:
+        total += math.hypot(path[0][0] - x, path[0][1] - y)
+        x, y = path[-1]
+    return total
+
+
+class _Tour:
+    # Порядок обхода: индексы линий и признак прохода в обратном направлении
+    def __init__(self, heads, tails, order, flipped, start):
+        self.heads = heads
+        self.tails = tails
+        self.order = order
+        self.flipped = flipped
+        self.start = start
+
+    def entry(self, k):
+        index = self.order[k]
+        return self.tails[index] if self.flipped[k] else self.heads[index]
+
+    def exit(self, k):
+        index = self.order[k]
+        return self.heads[index] if self.flipped[k] else self.tails[index]
+
+    def before(self, k):
+        # Точка, из которой выполняется переход к k-й линии
+        return self.start if k == 0 else self.exit(k - 1)
+
+    def reverse(self, i, j):
+        # Обратить порядок линий i..j, развернув каждую из них
+        self.order[i:j + 1] = self.order[i:j + 1][::-1]
+        self.flipped[i:j + 1] = [not flag for flag in self.flipped[i:j + 1][::-1]]
+
+
+def _dist(a, b):
+    return math.hypot(a[0] - b[0], a[1] - b[1])
+
+
+def _closest(index, ends, x, y, visited, count):
+    # Ближайший непосещённый конец линии: кольца ячеек сетки вокруг точки,
+    # пока следующее кольцо не может оказаться ближе найденного.
+    # Ячейки с посещёнными концами вычищаются по ходу поиска
+    cells = index.cells
+    size = index.cell_size
+    cx, cy = index.cell(x, y)
+    best = None
+    best_key = (math.inf, 0)
+    ring = 0
+    while cells and (best is None or (ring - 1) * size < best_key[0]):
+        everything = 8 * ring > len(cells)
+        if everything:
+            # Кольцо больше оставшихся ячеек: проще просмотреть все
+            keys = list(cells)
+        elif ring == 0:
+            keys = [(cx, cy)]
+        else:
+            keys = [(cx + dx, cy + dy) for dx in range(-ring, ring + 1)
+                    for dy in (-ring, ring)]
+            keys += [(cx + dx, cy + dy) for dx in (-ring, ring)
+                     for dy in range(-ring + 1, ring)]
+        for key in keys:
+            bucket = cells.get(key)
+            if bucket is None:
+                continue
+            live = [end for end in bucket if not visited[end % count]]
+            if not live:
+                del cells[key]
+                continue
+            if len(live) != len(bucket):
+                cells[key] = array('Q', live)
+            for end in live:
+                candidate = (math.hypot(ends[end][0] - x, ends[end][1] - y), end)
+                if candidate < best_key:
+                    best_key = candidate
+                    best = end
+        if everything:
+            break
+        ring += 1
+    return best
+
+
+def _nearest_neighbour(heads, tails, start, reversible, deadline):
+    # Концы линий раскладываются по сетке SpatialIndex, поэтому каждый шаг
+    # смотрит только соседние ячейки. Номер конца: i - начало i-й линии,
+    # count + i - её конец. Линии, до которых не дошли до deadline, идут
+    # в исходном порядке
+    count = len(heads)
+    ends = heads + tails if reversible else heads
+    xs = [point[0] for point in ends]
+    ys = [point[1] for point in ends]
+    span = max(max(xs) - min(xs), max(ys) - min(ys))
+    index = SpatialIndex(cell_size=max(span / math.sqrt(len(ends)), 1e-9))
+    for end, (x, y) in enumerate(ends):
+        index.add(end, x, y, x, y)
+
+    visited = [False] * count
+    order = []
+    flipped = []
+    x, y = start
+    for _ in range(count):
+        if time.monotonic() > deadline:
+            order.extend(i for i in range(count) if not visited[i])
+            flipped.extend([False] * (count - len(flipped)))
+            break
+        end = _closest(index, ends, x, y, visited, count)
+        best, flip = end % count, end >= count
+        visited[best] = True
+        order.append(best)
+        flipped.append(flip)
+        x, y = heads[best] if flip else tails[best]
+    return order, flipped
+
+
+def _two_opt(tour, window, deadline):
+    # Разворот участка i..j меняет только два перехода: перед i и после j
+    count = len(tour.order)
+    improved = False
+    for i in range(count):
+        if time.monotonic() > deadline:
+            break
+        before_i = tour.before(i)
+        entry_i = tour.entry(i)
+        for j in range(i + 1, min(count, i + window)):
+            exit_j = tour.exit(j)
+            old = _dist(before_i, entry_i)
+            new = _dist(before_i, exit_j)
+            if j + 1 < count:
+                entry_next = tour.entry(j + 1)
+                old += _dist(exit_j, entry_next)
+                new += _dist(entry_i, entry_next)
+            if new < old - 1e-9:
+                tour.reverse(i, j)
+                entry_i = tour.entry(i)
+                improved = True
+    return improved
+
+
+def _or_opt(tour, window, deadline, reversible):
+    # Перенос цепочки из 1-3 линий в другое место обхода (возможно, развёрнутой)
+    count = len(tour.order)
+    improved = False
+    for length in (1, 2, 3):
+        i = 0
+        while i + length <= count:
+            if time.monotonic() > deadline:
+                return improved
+            last = i + length - 1
+            chain_entry = tour.entry(i)
+            chain_exit = tour.exit(last)
+            before = tour.before(i)
+            removal = _dist(before, chain_entry)
+            if last + 1 < count:
+                after = tour.entry(last + 1)
+                removal += _dist(chain_exit, after) - _dist(before, after)
+
+            best = None
+            for p in range(max(-1, i - window), min(count, last + window)):
+                if i - 1 <= p <= last:
+                    continue
+                point = tour.start if p == -1 else tour.exit(p)
+                following = tour.entry(p + 1) if p + 1 < count else None
+                base = _dist(point, following) if following is not None else 0.0
+                options = [(False, chain_entry, chain_exit)]
+                if reversible:
+                    options.append((True, chain_exit, chain_entry))
+                for flip, first, final in options:
+                    cost = _dist(point, first) - base
+                    if following is not None:
+                        cost += _dist(final, following)
+                    gain = removal - cost
+                    if gain > 1e-9 and (best is None or gain > best[0]):
+                        best = (gain, p, flip)
+
+            if best is None:
+                i += 1
+                continue
+            _, p, flip = best
+            order = tour.order[i:last + 1]
+            flags = tour.flipped[i:last + 1]
+            if flip:
+                order = order[::-1]
+                flags = [not flag for flag in flags[::-1]]
+            del tour.order[i:last + 1]
+            del tour.flipped[i:last + 1]
+            position = p + 1 if p < i else p + 1 - length
+            tour.order[position:position] = order
+            tour.flipped[position:position] = flags
+            improved = True
+    return improved
+
+
+def _rotate_closed(paths, start):
+    # Замкнутую линию можно начать с любой вершины: выбирается ближайшая
+    # к точке, где закончилась предыдущая линия
+    result = []
+    x, y = start
+    for path in paths:
+        if len(path) > 2 and tuple(path[0]) == tuple(path[-1]):
+            points = np.array(path[:-1], dtype=np.float64)
+            k = int(np.argmin(np.hypot(points[:, 0] - x, points[:, 1] - y)))
+            path = path[k:-1] + path[:k + 1]
+        result.append(path)
+        x, y = path[-1]
+    return result
+
+
+def optimize_paths(paths, start=(0.0, 0.0), time_budget=1.0, reversible=True,
+                   travel_speed=100.0, window=50):
+    # Порядок и направление линий, минимизирующие холостые переходы:
+    # ближайший сосед, затем улучшения 2-opt и Or-opt в пределах time_budget секунд.
+    # Возвращает новые линии и отчёт с оценкой сэкономленного времени
+    paths = [list(path) for path in paths if len(path)]
+    before = travel_length(paths, start)
+    if not paths:
+        ordered = []
+    else:
+        deadline = time.monotonic() + time_budget
+        heads = [tuple(path[0]) for path in paths]
+        tails = [tuple(path[-1]) for path in paths]
+        order, flipped = _nearest_neighbour(heads, tails, start, reversible, deadline)
+        tour = _Tour(heads, tails, order, flipped, tuple(start))
+        while time.monotonic() < deadline:
+            improved = _two_opt(tour, window, deadline) if reversible else False
+            improved = _or_opt(tour, window, deadline, reversible) or improved
+            if not improved:
+                break
+        ordered = [paths[index][::-1] if flip else paths[index]
+                   for index, flip in zip(tour.order, tour.flipped)]
+        ordered = _rotate_closed(ordered, start)
+
+    after = travel_length(ordered, start)
+    report = {
+        'paths': len(ordered),
+        'travel_before': before,
+        'travel_after': after,
+        'time_before': before / travel_speed,
+        'time_after': after / travel_speed,
+        'time_saved': (before - after) / travel_speed,
+    }
+    # Если эвристика не помогла, исходный порядок не хуже
+    if after > before:
+        ordered = paths
+        report['travel_after'] = before
+        report['time_after'] = report['time_before']
+        report['time_saved'] = 0.0
+    return ordered, report
+
+
+def optimize_batches(batches, report, start=(0.0, 0.0), time_budget=0.1, reversible=True,
+                     travel_speed=100.0, window=50):
+    # То же для потока частей (полос растра): каждая часть оптимизируется
+    # отдельно, начиная с точки, где закончилась предыдущая. Отчёт по всем
+    # частям накапливается в report по мере прохода
+    for key in ('paths', 'travel_before', 'travel_after', 'time_before', 'time_after',
+                'time_saved'):
+        report[key] = 0
+    for paths in batches:
+        paths, part = optimize_paths(paths, start, time_budget, reversible, travel_speed, window)
+        for key, value in part.items():
+            report[key] += value
+        if paths:
+            start = tuple(paths[-1][-1])
+        yield paths
@@ -0,0 +1,239 @@
+import json
+import struct
+import sys
+from array import array
+
+# Двоичный протокол включается командой "PROTO BINARY [F32]" текстового протокола.
+# После ответа на неё обе стороны обмениваются кадрами: заголовок <тип u8, длина u32>
+# и полезная нагрузка указанной длины
+FRAME_TEXT = 0     # Строка текстового протокола (только внутри Decoder)
+FRAME_JSON = 1     # JSON в UTF-8: ответы на команды, снимки состояния
+FRAME_DELTA = 2    # Обновление: запись состояния и упакованные точки линий
+FRAME_COMMAND = 3  # Команда клиента в UTF-8
+
+HEADER = struct.Struct('<BI')
+DELTA_RECORD = struct.Struct('<QHddd')  # seq, флаги, x, y, speed
+STROKE_HEADER = struct.Struct('<III')   # номер линии, позиция в линии, количество точек
+COUNT = struct.Struct('<I')             # число линий, длина JSON прочих полей
+
+HAS_X = 0x01
+HAS_Y = 0x02
+HAS_LASER = 0x04
+LASER_ON = 0x08
+HAS_SPEED = 0x10
+CLEAR = 0x20
+FLOAT32 = 0x40
+HAS_EXTRA = 0x80
+
+RECORD_FIELDS = ('type', 'seq', 'x', 'y', 'laser_on', 'speed', 'clear', 'strokes')
+MAX_MESSAGE = 16 << 20
+
+
+def frame(kind, payload):
+    return HEADER.pack(kind, len(payload)) + payload
+
+
+def pairs(coords):
+    return [[coords[i], coords[i + 1]] for i in range(0, len(coords), 2)]
+
+
+def delta_to_json(delta):
+    # Точки линий хранятся плоскими массивами; в JSON они идут парами
+    if 'strokes' not in delta:
+        return delta
+    result = dict(delta)
+    result['strokes'] = [[index, offset, pairs(coords)]
+                         for index, offset, coords in delta['strokes']]
+    return result
+
+
+def encode_reply(mode, text):
+    if mode == 'text':
+        return text.encode('utf-8') + b"\n"
+    return frame(FRAME_JSON, text.encode('utf-8'))
+
+
+def split_request_id(command):
+    # "#id КОМАНДА" -> ('id', 'КОМАНДА'); без метки - (None, команда).
+    # Ответ на команду с меткой содержит её в поле id, так клиент может
+    # отправлять команды, не дожидаясь ответов, и сопоставлять их потом
+    if not command.startswith('#'):
+        return None, command
+    parts = command.split(None, 1)
+    return parts[0][1:], parts[1] if len(parts) > 1 else ''
+
+
+def tag_reply(text, request_id):
+    # Ответы - всегда JSON-объекты: id дописывается первым полем без разбора
+    if request_id is None:
+        return text
+    tag = '{"id": ' + json.dumps(request_id)
+    return tag + '}' if text == '{}' else tag + ', ' + text[1:]
+
+
+def protocol_mode(parts):
+    # PROTO TEXT | PROTO BINARY [F32]: новый режим или None
+    args = [part.upper() for part in parts[1:]]
+    if args == ['TEXT']:
+        return 'text'
+    if args == ['BINARY']:
+        return 'binary'
+    if args == ['BINARY', 'F32']:
+        return 'binary32'
+    return None
+
+
+def encode_command(mode, command):
+    if mode == 'text':
+        return f"{command}\n".encode('utf-8')
+    return frame(FRAME_COMMAND, command.encode('utf-8'))
+
+
+def encode_delta(delta, float32=False):
+    flags = FLOAT32 if float32 else 0
+    if 'x' in delta:
+        flags |= HAS_X
+    if 'y' in delta:
+        flags |= HAS_Y
+    if 'laser_on' in delta:
+        flags |= HAS_LASER | (LASER_ON if delta['laser_on'] else 0)
+    if 'speed' in delta:
+        flags |= HAS_SPEED
+    if delta.get('clear'):
+        flags |= CLEAR
+    extra = {key: value for key, value in delta.items() if key not in RECORD_FIELDS}
+    if extra:
+        flags |= HAS_EXTRA
+
+    strokes = delta.get('strokes', [])
+    parts = [DELTA_RECORD.pack(delta['seq'], flags, delta.get('x', 0.0),
+                               delta.get('y', 0.0), delta.get('speed', 0.0)),
+             COUNT.pack(len(strokes))]
+    for index, offset, coords in strokes:
+        if float32 or sys.byteorder == 'big':
+            coords = array('f' if float32 else 'd', coords)
+            if sys.byteorder == 'big':
+                coords.byteswap()
+        parts.append(STROKE_HEADER.pack(index, offset, len(coords) // 2))
+        parts.append(coords.tobytes())
+    if extra:
+        data = json.dumps(extra).encode('utf-8')
+        parts.append(COUNT.pack(len(data)))
+        parts.append(data)
+    return frame(FRAME_DELTA, b"".join(parts))
+
+
+def decode_delta(payload):
+    seq, flags, x, y, speed = DELTA_RECORD.unpack_from(payload, 0)
+    delta = {'type': 'delta', 'seq': seq}
+    if flags & HAS_X:
+        delta['x'] = x
+    if flags & HAS_Y:
+        delta['y'] = y
+    if flags & HAS_LASER:
+        delta['laser_on'] = bool(flags & LASER_ON)
+    if flags & HAS_SPEED:
+        delta['speed'] = speed
+    if flags & CLEAR:
+        delta['clear'] = True
+
+    offset = DELTA_RECORD.size
+    (count,) = COUNT.unpack_from(payload, offset)
+    offset += COUNT.size
+    typecode = 'f' if flags & FLOAT32 else 'd'
+    strokes = []
+    for _ in range(count):
+        index, start, points = STROKE_HEADER.unpack_from(payload, offset)
+        offset += STROKE_HEADER.size
+        coords = array(typecode)
+        end = offset + points * 2 * coords.itemsize
+        coords.frombytes(payload[offset:end])
+        if sys.byteorder == 'big':
+            coords.byteswap()
+        offset = end
+        strokes.append([index, start, pairs(coords)])
+    if strokes:
+        delta['strokes'] = strokes
+    if flags & HAS_EXTRA:
+        (length,) = COUNT.unpack_from(payload, offset)
+        offset += COUNT.size
+        delta.update(json.loads(payload[offset:offset + length]))
+    return delta
+
+
+def encode_update(delta, mode):
+    if mode == 'text':
+        return (json.dumps(delta_to_json(delta)) + "\n").encode('utf-8')
+    return encode_delta(delta, float32=mode == 'binary32')
+
+
+def decode_message(kind, payload):
+    # Сообщение сервера в виде словаря независимо от способа кодирования
+    if kind == FRAME_DELTA:
+        return decode_delta(payload)
+    return json.loads(payload.decode('utf-8'))
+
+
+class Update:
+    # Обновление, кодируемое не более одного раза для каждого режима клиентов
+    def __init__(self, delta):
+        self.delta = delta
+        self.cache = {}
+
+    def encoded(self, mode):
+        data = self.cache.get(mode)
+        if data is None:
+            data = encode_update(self.delta, mode)
+            self.cache[mode] = data
+        return data
+
+
+class Decoder:
+    # Разбор входящего потока: строки в текстовом режиме и кадры в двоичном.
+    # Данные копятся в bytearray с позицией чтения, поэтому разбор большой
+    # пачки сообщений линеен, а не квадратичен. Режим можно переключить
+    # между сообщениями: остаток буфера будет разобран уже по-новому
+    def __init__(self, max_message=MAX_MESSAGE):
+        self.buffer = bytearray()
+        self.pos = 0
+        self.scan = 0  # До этой позиции перевода строки точно нет
+        self.binary = False
+        self.max_message = max_message  # None - без ограничения
+
+    def feed(self, data):
+        if self.pos and self.pos * 2 >= len(self.buffer):
+            del self.buffer[:self.pos]
+            self.scan = max(self.scan - self.pos, 0)
+            self.pos = 0
+        self.buffer += data
+
+    def next(self):
+        buffer = self.buffer
+        if not self.binary:
+            end = buffer.find(b"\n", max(self.pos, self.scan))
+            if end == -1:
+                self.scan = len(buffer)
+                if self.max_message is not None and self.scan - self.pos > self.max_message:
+                    raise ValueError('Слишком длинное сообщение')
+                return None
+            line = bytes(buffer[self.pos:end])
+            self.pos = end + 1
+            return FRAME_TEXT, line
+
+        if len(buffer) - self.pos < HEADER.size:
+            return None
+        kind, length = HEADER.unpack_from(buffer, self.pos)
+        if self.max_message is not None and length > self.max_message:
+            raise ValueError('Слишком длинное сообщение')
+        start = self.pos + HEADER.size
+        if len(buffer) - start < length:
+            return None
+        self.pos = start + length
+        return kind, bytes(buffer[start:self.pos])
+
+    def __iter__(self):
+        while True:
+            message = self.next()
+            if message is None:
+                return
+            yield message
@@ -0,0 +1,212 @@
+import struct
+import numpy as np
+
+
+def qimage_to_array(image):
+    # Буфер QImage в формате Grayscale8 как массив (height, width) без копирования.
+    # Массив ссылается на память изображения и действителен, пока оно живо
+    height = image.height()
+    stride = image.bytesPerLine()
+    ptr = image.constBits()
+    ptr.setsize(stride * height)
+    buffer = np.frombuffer(ptr, dtype=np.uint8).reshape(height, stride)
+    return buffer[:, :image.width()]
+
+
+def extract_spans(gray, threshold=128, row_step=1, serpentine=False, merge_gap=0,
+                  reverse_first=False):
+    # Тёмные участки строк в виде массива (n, 3): y, x начала, x конца (включительно).
+    # При serpentine чётные по счёту строки идут справа налево (x начала > x конца),
+    # с reverse_first - нечётные (продолжение змейки из предыдущей полосы)
+    rows = gray[::row_step]
+    height, width = rows.shape
+    dark = np.zeros((height, width + 2), dtype=np.int8)
+    dark[:, 1:-1] = rows < threshold
+    edges = np.diff(dark, axis=1)
+    row_index, starts = np.nonzero(edges == 1)
+    ends = np.nonzero(edges == -1)[1] - 1
+
+    if merge_gap > 0 and len(starts) > 1:
+        # Соседние участки строки с промежутком не более merge_gap сливаются
+        merged = (row_index[1:] == row_index[:-1]) & (starts[1:] - ends[:-1] - 1 <= merge_gap)
+        first = np.concatenate(([True], ~merged))
+        last = np.concatenate((~merged, [True]))
+        row_index = row_index[first]
+        starts = starts[first]
+        ends = ends[last]
+
+    spans = np.empty((len(starts), 3), dtype=np.int32)
+    spans[:, 0] = row_index * row_step
+    spans[:, 1] = starts
+    spans[:, 2] = ends
+
+    if serpentine and len(spans):
+        _, rank = np.unique(row_index, return_inverse=True)
+        reverse = rank % 2 == (0 if reverse_first else 1)
+        order = np.lexsort((np.where(reverse, -starts, starts), row_index))
+        spans = spans[order]
+        reverse = reverse[order]
+        spans[reverse, 1], spans[reverse, 2] = spans[reverse, 2], spans[reverse, 1]
+    return spans
+
+
+class ArrayBands:
+    # Полосы строк уже загруженного изображения (массив оттенков серого)
+    def __init__(self, gray):
+        self.gray = gray
+        self.height, self.width = gray.shape
+
+    def band(self, y0, y1):
+        return self.gray[y0:y1]
+
+    def close(self):
+        pass
+
+
+class FileBands:
+    # Полосы строк несжатого файла: каждая читается отдельно, так что в памяти
+    # не больше одной полосы независимо от размера изображения
+    def __init__(self, path, width, height, offset, stride, channels, bgr=False,
+                 bottom_up=False, levels=None):
+        self.file = open(path, 'rb')
+        self.width = width
+        self.height = height
+        self.offset = offset        # Начало данных пикселей
+        self.stride = stride        # Байт на строку в файле
+        self.channels = channels    # 1 - серый или палитра, 3-4 - цвет
+        self.bgr = bgr              # BMP хранит цвет как BGR(A), PPM - RGB
+        self.bottom_up = bottom_up  # BMP хранит строки снизу вверх
+        # Яркость 0-255 по значению байта: палитра BMP или растяжение PNM
+        # с maxval < 255
+        self.levels = levels
+
+    def band(self, y0, y1):
+        first = self.height - y1 if self.bottom_up else y0
+        self.file.seek(self.offset + first * self.stride)
+        data = self.file.read((y1 - y0) * self.stride)
+        if len(data) < (y1 - y0) * self.stride:
+            raise ValueError('Файл изображения обрезан')
+        rows = np.frombuffer(data, dtype=np.uint8).reshape(y1 - y0, self.stride)
+        if self.bottom_up:
+            rows = rows[::-1]
+        pixels = rows[:, :self.width * self.channels].reshape(y1 - y0, self.width, self.channels)
+        if self.channels == 1:
+            gray = pixels[:, :, 0]
+        else:
+            if self.bgr:
+                blue, green, red = pixels[:, :, 0], pixels[:, :, 1], pixels[:, :, 2]
+            else:
+                red, green, blue = pixels[:, :, 0], pixels[:, :, 1], pixels[:, :, 2]
+            gray = _luminance(red, green, blue)
+        if self.levels is not None:
+            return self.levels[gray]
+        return gray
+
+    def close(self):
+        self.file.close()
+
+
+def _luminance(red, green, blue):
+    # Яркость по ITU-R BT.601 в целых числах
+    gray = (77 * red.astype(np.uint16) + 150 * green.astype(np.uint16)
+            + 29 * blue.astype(np.uint16)) >> 8
+    return gray.astype(np.uint8)
+
+
+def _read_netpbm_header(f):
+    # P5/P6: сигнатура, ширина, высота, maxval, комментарии после '#'
+    fields = []
+    token = b''
+    while len(fields) < 4:
+        char = f.read(1)
+        if not char:
+            raise ValueError('Неверный файл PNM')
+        if char == b'#':
+            f.readline()
+        elif char.isspace():
+            if token:
+                fields.append(token)
+                token = b''
+        else:
+            token += char
+    return fields, f.tell()
+
+
+def open_image_bands(path):
+    # Источник полос для PGM/PPM (P5/P6, 8 бит) и несжатого BMP (8/24/32 бит);
+    # None для остальных форматов
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+        if magic in (b'P5', b'P6'):
+            f.seek(0)
+            (_, width, height, maxval), offset = _read_netpbm_header(f)
+            maxval = int(maxval)
+            if not 0 < maxval <= 255:
+                return None
+            levels = None
+            if maxval < 255:
+                levels = (np.minimum(np.arange(256), maxval) * 255 // maxval).astype(np.uint8)
+            channels = 1 if magic == b'P5' else 3
+            width, height = int(width), int(height)
+            return FileBands(path, width, height, offset, width * channels, channels,
+                             levels=levels)
+        if magic != b'BM':
+            return None
+        header = f.read(52)
+    if len(header) < 36:
+        return None
+    offset, dib_size, width, height, _, bpp, compression = struct.unpack_from('<IIiiHHI', header, 8)
+    colors = struct.unpack_from('<I', header, 44)[0] if len(header) >= 48 else 0
+    if compression not in (0, 3) or bpp not in (8, 24, 32) or (compression == 3 and bpp != 32):
+        return None
+    stride = (bpp * width + 31) // 32 * 4
+    palette = None
+    if bpp == 8:
+        with open(path, 'rb') as f:
+            f.seek(14 + dib_size)
+            entries = np.frombuffer(f.read(4 * (colors or 256)), dtype=np.uint8).reshape(-1, 4)
+        palette = np.zeros(256, dtype=np.uint8)
+        palette[:len(entries)] = _luminance(entries[:, 2], entries[:, 1], entries[:, 0])
+    return FileBands(path, width, abs(height), offset, stride, bpp // 8, bgr=True,
+                     bottom_up=height > 0, levels=palette)
+
+
+def stream_paths(source, threshold=128, scale=1.0, line_spacing=None, band_rows=256,
+                 serpentine=False, merge_gap=0):
+    # Линии растровой гравировки по полосам изображения: генератор списков
+    # отрезков в системе координат станка. scale - размер пикселя в единицах
+    # станка, line_spacing - расстояние между строками гравировки (по умолчанию
+    # строка на пиксель). Строка гравировки - среднее попавших в неё строк
+    # изображения, так что шаг больше пикселя не теряет тонкие детали
+    line_spacing = line_spacing or scale
+    width, height = source.width, source.height
+    line_count = int(height * scale / line_spacing)
+    x_offset = width // 2
+    y_top = height // 2 * scale
+    reverse_first = False
+    line = 0
+    while line < line_count:
+        # Строки гравировки, укладывающиеся примерно в band_rows строк изображения
+        lines_per_band = max(1, int(band_rows * scale / line_spacing))
+        last = min(line + lines_per_band, line_count)
+        starts = (np.arange(line, last + 1) * line_spacing / scale).astype(np.int64)
+        starts = np.minimum(starts, height)
+        ends = np.maximum(starts[1:], starts[:-1] + 1)
+        y0, y1 = int(starts[0]), int(min(ends[-1], height))
+        band = source.band(y0, y1).astype(np.float32)
+        sums = np.add.reduceat(band, starts[:-1] - y0, axis=0)
+        rows = (sums / (ends - starts[:-1])[:, None]).astype(np.uint8)
+
+        spans = extract_spans(rows, threshold, serpentine=serpentine, merge_gap=merge_gap,
+                              reverse_first=reverse_first)
+        if serpentine:
+            # Змейка продолжается через границу полос
+            dark_rows = int(np.count_nonzero((rows < threshold).any(axis=1)))
+            reverse_first ^= dark_rows % 2 == 1
+        paths = []
+        for index, x_start, x_end in spans.tolist():
+            target_y = y_top - (line + index) * line_spacing
+            paths.append([((x_start - x_offset) * scale, target_y),
+                          ((x_end - x_offset) * scale, target_y)])
+        yield paths
+        line = last
@@ -1,166 +1,409 @@
+import argparse
 import socket
 import threading
-import json
 import time
-import math
+import json
+from collections import deque
+from contextlib import nullcontext
 from virtual_laser_machine import VirtualLaserMachine
+from job import Job, parse_ops
+from motion_planner import MotionPlanner
+from clock import make_clock
+from broadcaster import Broadcaster
+from journal import Journal, capture, write_snapshot, read_snapshot
+from gcode import GCodeParser, export_gcode
+from simplify import DEFAULT_EPSILON, compact_history
+from metrics import Metrics, TimedLock, BYTE_BUCKETS
+from protocol import (
+    Decoder, Update, FRAME_TEXT, FRAME_COMMAND, delta_to_json, encode_reply,
+    protocol_mode, split_request_id, tag_reply
+)
+
+# Команды process_command; остальные учитываются в метриках как OTHER
+COMMANDS = frozenset((
+    'MOVE', 'SPEED', 'LASER', 'ACCEL', 'STOP', 'FLUSH', 'CLEAR', 'GET_STATUS', 'RESYNC',
+    'HISTORY_QUERY', 'SAVE', 'LOAD', 'COMPACT', 'JOB', 'GCODE', 'EXPORT_GCODE', 'METRICS',
+))
+
+# Команды, которые ждут места в очереди планировщика и могут надолго занять
+# поток; остальные (STOP, FLUSH, GET_STATUS...) завершаются сразу
+PLANNER_COMMANDS = frozenset(('MOVE', 'SPEED', 'LASER', 'GCODE'))
+
+
+def blocks_on_planner(command):
+    _, command = split_request_id(command.strip())
+    parts = command.split(None, 1)
+    return bool(parts) and parts[0].upper() in PLANNER_COMMANDS
+
+
+class ClientChannel:
+    # Соединение клиента: режим протокола и отправка целыми сообщениями,
+    # чтобы ответы и рассылка из разных потоков не перемешивались
+    def __init__(self, client_socket, addr):
+        self.socket = client_socket
+        self.addr = addr
+        self.mode = 'text'
+        self.subscribed = False  # Рассылка обновлений только после SUBSCRIBE
+        self.seq = 0             # Номер ответа на SUBSCRIBE
+        self.lock = threading.Lock()
+
+    def send(self, data, mode=None):
+        with self.lock:
+            self.socket.sendall(data)
+            if mode is not None:
+                self.mode = mode
+
+    def send_update(self, update):
+        with self.lock:
+            data = update.encoded(self.mode)
+            self.socket.sendall(data)
+        return len(data)
+
 
 class Server:
-    def __init__(self, host='localhost', port=12345):
+    def __init__(self, host='localhost', port=12345, clock=None, broadcast_rate=30.0,
+                 journal_dir=None, epsilon=DEFAULT_EPSILON, metrics=None):
         self.host = host
         self.port = port
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
-        self.machine = VirtualLaserMachine()
-        self.lock = threading.Lock()
+        self.server_socket = self.bind()
+        self.machine = VirtualLaserMachine(epsilon)
+        self.metrics = metrics  # None - метрики выключены
+        if metrics is None:
+            self.lock = threading.Lock()
+        else:
+            self.lock = TimedLock(metrics.histogram('laser_lock_wait_seconds'))
+        self.broadcast_lock = threading.RLock()
+        self.backlog = deque(maxlen=1024)  # Последние обновления для RESYNC
         self.running = True
         self.clients = []
-        self.movement_thread = None
-        self.should_stop = False
+        self.journal = None
+        if journal_dir:
+            # История восстанавливается до запуска движения и рассылки
+            self.journal = Journal(journal_dir, self.machine, self.lock)
+            points = self.journal.recover()
+            print(f"Восстановлено точек из журнала: {points}")
+            self.journal.start()
+        self.broadcaster = Broadcaster(self.broadcast_update, broadcast_rate)
+        self.broadcaster.start()
+        self.planner = MotionPlanner(self.machine, self.lock, self.broadcaster.mark_dirty,
+                                     self.broadcaster.notify, clock=clock)
+        self.planner.metrics = metrics
+        self.planner.start()
+        if metrics is not None:
+            self.register_gauges(metrics)
+        self.job = Job()
+        self.job_thread = None
+        self.gcode = None  # Разбор загружаемого по частям G-кода
+        self.gcode_cancelled = False  # После STOP части отвергаются до GCODE END
+        self.gcode_lock = threading.Lock()
         self.MAX_COORD = 250  # Максимальное значение координат
 
+    def bind(self):
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind((self.host, self.port))
+        server_socket.listen(128)
+        return server_socket
+
     def start(self):
         print("Сервер запущен...")
         while self.running:
             try:
                 client_socket, addr = self.server_socket.accept()
                 print(f"Подключение от {addr}")
-                self.clients.append(client_socket)
-                client_thread = threading.Thread(target=self.handle_client, args=(client_socket,))
+                client = ClientChannel(client_socket, addr)
+                self.clients.append(client)
+                client_thread = threading.Thread(target=self.handle_client, args=(client,))
                 client_thread.start()
             except OSError:
                 break
 
+    def register_gauges(self, metrics):
+        # Читаются без блокировки: значения приблизительные
+        history = self.machine.history
+        metrics.gauge('laser_history_points', lambda: history.point_count)
+        metrics.gauge('laser_history_strokes', lambda: len(history))
+        metrics.gauge('laser_history_bytes', lambda: history.nbytes)
+        metrics.gauge('laser_planner_queue', lambda: len(self.planner.queue))
+        metrics.gauge('laser_clients', lambda: len(self.clients))
+        metrics.gauge('laser_seq', lambda: self.machine.seq)
+
     def broadcast_update(self):
-        status = json.dumps(self.machine.get_status()) + "\n"
+        metrics = self.metrics
+        if metrics is None:
+            with self.broadcast_lock:
+                self._publish_delta()
+            return
+        started = time.perf_counter()
+        with self.broadcast_lock:
+            self._publish_delta()
+        metrics.observe('laser_broadcast_seconds', time.perf_counter() - started)
+
+    def _publish_delta(self):
+        # Под блокировкой станка: CLEAR и LOAD заменяют массивы истории
+        with self.lock:
+            delta = self.machine.take_delta()
+        if delta is None:
+            return
+        self.backlog.append(delta)
+        if self.metrics is not None:
+            self.metrics.inc('laser_updates_total')
+        self.send_update(Update(delta))
+
+    def send_update(self, update):
+        metrics = self.metrics
         for client in self.clients.copy():
+            if not client.subscribed:
+                continue
             try:
-                client.sendall(status.encode('utf-8'))
+                sent = client.send_update(update)
+                if metrics is not None:
+                    self.count_sent(sent)
             except (ConnectionResetError, BrokenPipeError, OSError):
-                self.clients.remove(client)
+                if client in self.clients:
+                    self.clients.remove(client)
 
-    def handle_movement(self, target_x, target_y):
-        with self.lock:
-            self.should_stop = False
-            start_x = self.machine.x
-            start_y = self.machine.y
-            
-            # Корректировка координат
-            target_x = max(-self.MAX_COORD, min(target_x, self.MAX_COORD))
-            target_y = max(-self.MAX_COORD, min(target_y, self.MAX_COORD))
-            
-            dx = target_x - start_x
-            dy = target_y - start_y
-            distance = math.hypot(dx, dy)
-            
-            if distance == 0:
-                return
-
-            steps = max(1, int(round(distance)))
-            time_per_step = 1.0 / self.machine.speed
-            step_x = dx / steps
-            step_y = dy / steps
-
-            current_line = []
-            initial_laser_on = self.machine.laser_on
-
-            if initial_laser_on:
-                current_line.append((start_x, start_y))
-                self.machine.history.append(current_line)
-
-            for i in range(steps):
-                if not self.running or self.should_stop:
-                    break
-                
-                if (initial_laser_on and not self.machine.laser_on) or (not initial_laser_on and self.machine.laser_on):
-                    break
-                
-                self.machine.x = start_x + step_x * (i + 1)
-                self.machine.y = start_y + step_y * (i + 1)
-                
-                if initial_laser_on and current_line:
-                    current_line.append((self.machine.x, self.machine.y))
-                    self.machine.history[-1] = current_line.copy()
-                
-                self.broadcast_update()
-                time.sleep(time_per_step)
-
-            if initial_laser_on and current_line:
-                current_line.append((self.machine.x, self.machine.y))
-
-    def handle_client(self, client_socket):
-        buffer = b""
-        with client_socket:
+    def count_sent(self, size):
+        metrics = self.metrics
+        metrics.observe('laser_broadcast_client_bytes', size, buckets=BYTE_BUCKETS)
+        metrics.inc('laser_broadcast_bytes_total', size)
+
+    def snapshot(self):
+        # Полное состояние с номером последнего разосланного обновления.
+        # Изменения, ещё не разосланные, в нём уже есть: следующее обновление
+        # перепишет их на тех же позициях линий, так что рассылка не
+        # ускоряется запросами состояния
+        with self.broadcast_lock:
+            with self.lock:
+                return self.machine.get_status()
+
+    def resync(self, since):
+        # Недостающие разосланные обновления; неразосланные придут со следующим
+        with self.broadcast_lock:
+            if since >= self.machine.seq:
+                return {'type': 'resync', 'seq': self.machine.seq, 'deltas': []}
+            if self.backlog and self.backlog[0]['seq'] <= since + 1:
+                deltas = [delta_to_json(delta) for delta in self.backlog if delta['seq'] > since]
+                return {'type': 'resync', 'seq': self.machine.seq, 'deltas': deltas}
+            return self.snapshot()
+
+    def subscribe(self, client, since=None):
+        # Ответ (снимок или недостающие обновления) и включение рассылки
+        # согласованы: следующее обновление клиента будет с seq + 1
+        with self.broadcast_lock:
+            status = self.snapshot() if since is None else self.resync(since)
+            # Номер ответа: рассылка asyncio отбрасывает обновления, которые
+            # уже в нём учтены, но попали в цикл событий позже
+            client.seq = status['seq']
+            client.subscribed = True
+            return status
+
+    def handle_client(self, client):
+        decoder = Decoder()
+        with client.socket:
             while self.running:
                 try:
-                    data = client_socket.recv(4096)
+                    data = client.socket.recv(65536)
                     if not data:
                         break
-                    buffer += data
-
-                    while True:
-                        msg_end = buffer.find(b"\n")
-                        if msg_end == -1:
-                            break
+                    decoder.feed(data)
 
-                        full_msg = buffer[:msg_end]
-                        buffer = buffer[msg_end+1:]
-                        response = self.process_command(full_msg.decode('utf-8'))
-                        client_socket.sendall(response.encode('utf-8') + b"\n")
+                    for kind, payload in decoder:
+                        response, mode = self.handle_request(client, kind, payload)
+                        client.send(response, mode)
+                        if mode is not None:
+                            decoder.binary = mode != 'text'
 
-                except (ConnectionResetError, BrokenPipeError):
+                except (ConnectionResetError, BrokenPipeError, ValueError):
                     break
-        print(f"Клиент отключен: {client_socket.getpeername()}")
+        if client in self.clients:
+            self.clients.remove(client)
+        print(f"Клиент отключен: {client.addr}")
+
+    def handle_request(self, client, kind, payload):
+        # Возвращает закодированный ответ и новый режим протокола (или None).
+        # Здесь же обрабатываются команды, относящиеся к самому соединению
+        mode = client.mode
+        if kind not in (FRAME_TEXT, FRAME_COMMAND):
+            return encode_reply(mode, json.dumps({'error': 'Неверный кадр'})), None
+        request_id, command = split_request_id(payload.decode('utf-8').strip())
+        response, new_mode = self.handle_command(client, command)
+        # Ответ на PROTO уходит ещё в старом режиме, дальше - в новом
+        return encode_reply(mode, tag_reply(response, request_id)), new_mode
+
+    def handle_command(self, client, command):
+        parts = command.split()
+        if parts and parts[0].upper() == 'PROTO':
+            new_mode = protocol_mode(parts)
+            if new_mode is None:
+                return json.dumps({'error': 'Неверная команда PROTO'}), None
+            return json.dumps({'type': 'proto', 'mode': new_mode}), new_mode
+        if parts and parts[0].upper() in ('SUBSCRIBE', 'UNSUBSCRIBE'):
+            return self.process_subscription(client, parts), None
+        return self.process_command(command), None
+
+    def process_subscription(self, client, parts):
+        # SUBSCRIBE [seq] - снимок или обновления после seq, затем рассылка;
+        # UNSUBSCRIBE - остановка рассылки
+        try:
+            if parts[0].upper() == 'UNSUBSCRIBE':
+                if len(parts) != 1:
+                    return json.dumps({'error': 'Неверная команда UNSUBSCRIBE'})
+                client.subscribed = False
+                return json.dumps(self.machine.get_state())
+            if len(parts) > 2:
+                return json.dumps({'error': 'Неверная команда SUBSCRIBE'})
+            since = int(parts[1]) if len(parts) == 2 else None
+            return json.dumps(self.subscribe(client, since))
+        except Exception as e:
+            return json.dumps({'error': str(e)})
+
+    def clamp(self, value):
+        # Корректировка координат
+        return max(-self.MAX_COORD, min(value, self.MAX_COORD))
 
     def process_command(self, command):
+        metrics = self.metrics
+        if metrics is None:
+            return self.execute_command(command)
+        started = time.perf_counter()
+        response = self.execute_command(command)
+        elapsed = time.perf_counter() - started
+        name = command.split(None, 1)[0].upper() if command.strip() else ''
+        labels = (('command', name if name in COMMANDS else 'OTHER'),)
+        metrics.inc('laser_commands_total', labels=labels)
+        metrics.observe('laser_command_seconds', elapsed, labels)
+        if response.startswith('{"error"'):
+            metrics.inc('laser_command_errors_total', labels=labels)
+        return response
+
+    def execute_command(self, command):
         try:
             parts = command.strip().split()
             if not parts:
                 return json.dumps({'error': 'Пустая команда'})
 
             cmd = parts[0].upper()
+            if cmd in ('MOVE', 'SPEED', 'LASER', 'GCODE') and self.job.active:
+                return json.dumps({'error': 'Выполняется задание'})
+
             if cmd == 'MOVE':
                 if len(parts) != 3:
                     return json.dumps({'error': 'Неверная команда MOVE'})
-                x = float(parts[1])
-                y = float(parts[2])
-                
-                # Корректировка координат
-                x = max(-self.MAX_COORD, min(x, self.MAX_COORD))
-                y = max(-self.MAX_COORD, min(y, self.MAX_COORD))
-                
-                if self.movement_thread and self.movement_thread.is_alive():
-                    self.should_stop = True
-                    self.movement_thread.join()
-                
-                self.movement_thread = threading.Thread(
-                    target=self.handle_movement,
-                    args=(x, y)
-                )
-                self.movement_thread.start()
-                return json.dumps(self.machine.get_status())
+                self.planner.submit(('MOVE', self.clamp(float(parts[1])), self.clamp(float(parts[2]))))
+                return json.dumps(self.machine.get_state())
 
             elif cmd == 'SPEED':
                 if len(parts) != 2:
                     return json.dumps({'error': 'Неверная команда SPEED'})
-                self.machine.speed = float(parts[1])
-                return json.dumps(self.machine.get_status())
+                speed = float(parts[1])
+                if speed <= 0:
+                    return json.dumps({'error': 'Неверная скорость'})
+                self.planner.submit(('SPEED', speed))
+                return json.dumps(self.machine.get_state())
 
             elif cmd == 'LASER':
                 if len(parts) != 2:
                     return json.dumps({'error': 'Неверная команда LASER'})
-                self.machine.laser_on = parts[1].upper() == 'ON'
-                return json.dumps(self.machine.get_status())
+                self.planner.submit(('LASER', parts[1].upper() == 'ON'))
+                return json.dumps(self.machine.get_state())
+
+            elif cmd == 'ACCEL':
+                if len(parts) != 2:
+                    return json.dumps({'error': 'Неверная команда ACCEL'})
+                acceleration = float(parts[1])
+                if acceleration <= 0:
+                    return json.dumps({'error': 'Неверное ускорение'})
+                self.planner.acceleration = acceleration
+                return json.dumps(self.machine.get_state())
+
+            elif cmd == 'STOP':
+                # Немедленная остановка; активное задание и загрузка G-кода отменяются
+                if self.job.active:
+                    self.cancel_job()
+                if self.gcode is not None:
+                    self.cancel_gcode()
+                self.planner.stop()
+                return json.dumps(self.machine.get_state())
+
+            elif cmd == 'FLUSH':
+                self.planner.flush()
+                return json.dumps(self.machine.get_state())
 
             elif cmd == 'CLEAR':
-                self.machine.history = []
-                self.broadcast_update()
-                return json.dumps(self.machine.get_status())
+                with self.lock:
+                    self.machine.clear()
+                self.broadcaster.notify()
+                return json.dumps(self.machine.get_state())
 
             elif cmd == 'GET_STATUS':
-                return json.dumps(self.machine.get_status())
+                return json.dumps(self.snapshot())
+
+            elif cmd == 'RESYNC':
+                if len(parts) > 2:
+                    return json.dumps({'error': 'Неверная команда RESYNC'})
+                if len(parts) == 1:
+                    return json.dumps(self.snapshot())
+                return json.dumps(self.resync(int(parts[1])))
+
+            elif cmd == 'HISTORY_QUERY':
+                # HISTORY_QUERY x0 y0 x1 y1 [max_points]
+                if len(parts) not in (5, 6):
+                    return json.dumps({'error': 'Неверная команда HISTORY_QUERY'})
+                x0, y0, x1, y1 = (float(value) for value in parts[1:5])
+                max_points = int(parts[5]) if len(parts) == 6 else None
+                if max_points is not None and max_points <= 0:
+                    return json.dumps({'error': 'Неверное количество точек'})
+                with self.lock:
+                    result = self.machine.query_region(x0, y0, x1, y1, max_points)
+                return json.dumps(result)
+
+            elif cmd == 'SAVE':
+                if len(parts) != 2:
+                    return json.dumps({'error': 'Неверная команда SAVE'})
+                with self.lock:
+                    offsets, coords, state = capture(self.machine)
+                write_snapshot(parts[1], offsets, coords, state)
+                return json.dumps({'type': 'saved', 'strokes': len(offsets),
+                                   'points': len(coords) // 2})
+
+            elif cmd == 'LOAD':
+                if len(parts) != 2:
+                    return json.dumps({'error': 'Неверная команда LOAD'})
+                if self.job.active:
+                    return json.dumps({'error': 'Выполняется задание'})
+                return json.dumps(self.load_history(parts[1]))
+
+            elif cmd == 'COMPACT':
+                # COMPACT [epsilon] - упрощение уже записанной истории
+                if len(parts) > 2:
+                    return json.dumps({'error': 'Неверная команда COMPACT'})
+                epsilon = float(parts[1]) if len(parts) == 2 else self.machine.simplifier.epsilon
+                if epsilon < 0:
+                    return json.dumps({'error': 'Неверная точность'})
+                return json.dumps(self.compact_history(epsilon))
+
+            elif cmd == 'JOB':
+                return json.dumps(self.process_job_command(command))
+
+            elif cmd == 'GCODE':
+                return json.dumps(self.process_gcode_command(command))
+
+            elif cmd == 'METRICS':
+                if self.metrics is None:
+                    return json.dumps({'error': 'Метрики выключены'})
+                return json.dumps(self.metrics.as_dict())
+
+            elif cmd == 'EXPORT_GCODE':
+                if len(parts) != 2:
+                    return json.dumps({'error': 'Неверная команда EXPORT_GCODE'})
+                with self.lock:
+                    offsets, coords, _ = capture(self.machine)
+                with open(parts[1], 'w') as f:
+                    for line in export_gcode(offsets, coords):
+                        f.write(line + "\n")
+                return json.dumps({'type': 'exported', 'strokes': len(offsets),
+                                   'points': len(coords) // 2})
 
             else:
                 return json.dumps({'error': 'Неизвестная команда'})
@@ -168,13 +411,244 @@ class Server:
         except Exception as e:
             return json.dumps({'error': str(e)})
 
-    def shutdown(self):
+    def process_job_command(self, command):
+        parts = command.strip().split(None, 2)
+        if len(parts) < 2:
+            return {'error': 'Неверная команда JOB'}
+
+        action = parts[1].upper()
+        if action == 'UPLOAD':
+            if len(parts) != 3:
+                return {'error': 'Неверная команда JOB UPLOAD'}
+            if self.job.active and self.job.sealed:
+                return {'error': 'Выполняется задание'}
+            ops = parse_ops(json.loads(parts[2]))
+            # Задание можно загружать частями до команды JOB START,
+            # потоковое - и после неё, до JOB SEAL
+            if self.job.state not in ('idle', 'running', 'paused'):
+                self.job = Job()
+            self.job.add(ops)
+
+        elif action == 'START':
+            # JOB START STREAM - выполнение начинается, загрузка продолжается
+            stream = len(parts) == 3 and parts[2].strip().upper() == 'STREAM'
+            if len(parts) == 3 and not stream:
+                return {'error': 'Неверная команда JOB START'}
+            if self.job.state != 'idle' or not (self.job.total or stream):
+                return {'error': 'Нет загруженного задания'}
+            if self.gcode is not None or self.gcode_cancelled:
+                return {'error': 'Загружается G-код'}
+            self.planner.stop()
+            self.job.sealed = not stream
+            self.job.state = 'running'
+            self.job_thread = threading.Thread(target=self.run_job, args=(self.job,))
+            self.job_thread.start()
+
+        elif action == 'PAUSE':
+            if self.job.state != 'running':
+                return {'error': 'Задание не выполняется'}
+            self.job.state = 'paused'
+            self.planner.hold()
+
+        elif action == 'RESUME':
+            if self.job.state != 'paused':
+                return {'error': 'Задание не приостановлено'}
+            self.job.state = 'running'
+            self.planner.release()
+
+        elif action == 'SEAL':
+            if self.job.sealed:
+                return {'error': 'Задание не потоковое'}
+            self.job.seal()
+
+        elif action == 'CANCEL':
+            if not self.job.active:
+                return {'error': 'Задание не выполняется'}
+            self.cancel_job()
+
+        elif action != 'PROGRESS':
+            return {'error': 'Неверная команда JOB'}
+
+        self.update_job_progress()
+        return self.job.progress()
+
+    def load_history(self, path):
+        offsets, coords, state, _ = read_snapshot(path)
+        self.planner.stop()
+        self.planner.wait_idle()
+        self.replace_history(offsets, coords, state)
+        self.planner.stroke_open = False
+        return {'type': 'loaded', 'strokes': len(offsets), 'points': len(coords) // 2}
+
+    def compact_history(self, epsilon):
+        # Упрощение идёт по копии без блокировки; если за это время история
+        # изменилась, результат не применяется
+        with self.lock:
+            offsets, coords, _ = capture(self.machine)
+            revision = self.machine.revision
+        new_offsets, new_coords = compact_history(offsets, coords, epsilon)
+        if not self.replace_history(new_offsets, new_coords, revision=revision):
+            return {'error': 'История изменилась, повторите COMPACT'}
+        return {'type': 'compacted', 'strokes': len(new_offsets),
+                'points_before': len(coords) // 2, 'points': len(new_coords) // 2}
+
+    def replace_history(self, offsets, coords, state=None, revision=None):
+        # Замена истории целиком; в журнале она сразу становится новым снимком
+        machine = self.machine
+        with self.journal.write_lock if self.journal else nullcontext():
+            with self.lock:
+                if revision is not None and machine.revision != revision:
+                    return False
+                if state is None:
+                    state = (machine.x, machine.y, machine.speed, machine.laser_on)
+                machine.restore(offsets, coords, state)
+            if self.journal:
+                self.journal.snapshot()
+        self.broadcaster.notify()
+        return True
+
+    def process_gcode_command(self, command):
+        # GCODE "<часть текста в JSON>" ... GCODE END. Операции сразу уходят
+        # в планировщик; когда его очередь заполнена, команда ждёт, и клиент
+        # не может прислать следующую часть раньше, чем станок её примет
+        parts = command.strip().split(None, 1)
+        if len(parts) != 2:
+            return {'error': 'Неверная команда GCODE'}
+        with self.gcode_lock:
+            parser = self.gcode
+            if self.gcode_cancelled:
+                if parts[1].upper() == 'END':
+                    self.gcode_cancelled = False
+                return {'error': 'Загрузка G-кода отменена'}
+            if parts[1].upper() == 'END':
+                if parser is None:
+                    return {'error': 'G-код не загружается'}
+                self.submit_gcode(parser, parser.finish())
+                self.gcode = None
+                return {'type': 'gcode', 'state': 'done', 'lines': parser.lines, 'ops': parser.ops}
+
+            text = json.loads(parts[1])
+            if not isinstance(text, str):
+                return {'error': 'Неверная команда GCODE'}
+            if parser is None:
+                parser = self.gcode = GCodeParser(self.planner.position())
+            try:
+                self.submit_gcode(parser, parser.feed(text))
+            except ValueError:
+                # Без модального состояния (G91, G20, M3) продолжать файл нельзя:
+                # части отвергаются до GCODE END, лазер выключается
+                self.gcode = None
+                self.gcode_cancelled = True
+                self.planner.submit(('LASER', False))
+                raise
+            return {'type': 'gcode', 'state': 'streaming', 'lines': parser.lines, 'ops': parser.ops}
+
+    def submit_gcode(self, parser, ops):
+        for op in ops:
+            # STOP сбрасывает self.gcode: остаток части не отправляется
+            if self.gcode is not parser:
+                break
+            if op[0] == 'MOVE':
+                op = ('MOVE', self.clamp(op[1]), self.clamp(op[2]))
+            self.planner.submit(op)
+
+    def cancel_gcode(self):
+        # Как и при отмене задания: первая остановка освобождает поток
+        # загрузки, если он ждёт места в очереди, вторая - после его выхода
+        self.gcode = None
+        self.planner.stop()
+        with self.gcode_lock:
+            self.gcode = None
+            self.gcode_cancelled = True
+
+    def update_job_progress(self, event=True):
+        # Смена состояния задания рассылается сразу, счётчик операций - с тиком
+        self.machine.job = self.job.progress()
+        if event:
+            self.broadcaster.notify()
+        else:
+            self.broadcaster.mark_dirty()
+
+    def cancel_job(self):
+        self.job.cancel()
+        # Первая остановка освобождает поток задания, если он ждёт места
+        # в очереди, вторая убирает то, что он успел добавить
+        self.planner.stop()
+        self.job_thread.join()
+        self.planner.stop()
+
+    def run_job(self, job):
+        stopped = lambda: job.state == 'cancelled' or not self.running
+        index = 0
+        while True:
+            op = job.next_op(stopped)
+            if op is None:
+                break
+            if op[0] == 'MOVE':
+                op = ('MOVE', self.clamp(op[1]), self.clamp(op[2]))
+            self.planner.submit(op, callback=lambda index=index: self.complete_job_op(job, index))
+            index += 1
+
+        self.planner.wait_idle(stopped)
+        if job.state == 'running':
+            job.state = 'done'
+        self.update_job_progress()
+
+    def complete_job_op(self, job, index):
+        job.index = index + 1
+        self.update_job_progress(event=False)
+
+    def stop_machine(self):
+        self.planner.shutdown()
+        self.broadcaster.shutdown()
+        if self.journal:
+            self.journal.shutdown()
+        if self.metrics is not None:
+            self.metrics.shutdown()
         self.running = False
+
+    def shutdown(self):
+        self.stop_machine()
         self.server_socket.close()
         print("Сервер остановлен")
 
+def make_parser(description="Сервер виртуального лазерного станка"):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--clock', default='real',
+                        help="real, virtual или коэффициент ускорения (например, x10)")
+    parser.add_argument('--rate', type=float, default=30.0,
+                        help="частота рассылки обновлений, Гц")
+    parser.add_argument('--journal', default=None,
+                        help="каталог журнала истории (восстановление при запуске)")
+    parser.add_argument('--epsilon', type=float, default=DEFAULT_EPSILON,
+                        help="допустимое отклонение при упрощении записываемых линий")
+    parser.add_argument('--metrics', action='store_true',
+                        help="собирать метрики (команда METRICS)")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="порт HTTP для метрик в формате Prometheus (включает --metrics)")
+    return parser
+
+
+def parse_args():
+    return make_parser().parse_args()
+
+
+def make_metrics(args):
+    # Метрики по аргументам командной строки; None, если выключены
+    if not args.metrics and args.metrics_port is None:
+        return None
+    metrics = Metrics()
+    if args.metrics_port is not None:
+        port = metrics.serve(args.host, args.metrics_port)
+        print(f"Метрики: http://{args.host}:{port}/metrics")
+    return metrics
+
 if __name__ == "__main__":
-    server = Server()
+    args = parse_args()
+    server = Server(args.host, args.port, make_clock(args.clock), args.rate, args.journal,
+                    args.epsilon, make_metrics(args))
     try:
         server.start()
     except KeyboardInterrupt:
@@ -0,0 +1,113 @@
+import math
+from array import array
+
+DEFAULT_EPSILON = 0.01  # Допустимое отклонение от исходной траектории, единиц
+
+
+class StrokeSimplifier:
+    # Потоковое упрощение линии при записи. Последняя точка линии временная:
+    # новая точка заменяет её, пока все пропущенные точки лежат не дальше
+    # epsilon от отрезка anchor -> новая точка. Допустимые направления из
+    # anchor хранятся как пересечение конусов пропущенных точек, поэтому
+    # проверка занимает O(1) на точку. Точки на прямой схлопываются в концы
+    # отрезка при любом epsilon
+    def __init__(self, epsilon=DEFAULT_EPSILON):
+        self.epsilon = max(epsilon, 1e-9)
+        self.begin(0.0, 0.0)
+
+    def begin(self, x, y):
+        self.anchor_x = x
+        self.anchor_y = y
+        self.last = None  # Временная точка, если она есть
+        self.reset_cone()
+
+    def reset_cone(self):
+        self.reference = None  # Направление, относительно которого считаются углы
+        self.low = -math.pi
+        self.high = math.pi
+        self.reach = 0.0       # Наибольшее удаление пропущенных точек от anchor
+
+    def constrain(self, x, y):
+        # Сужает конус точкой (x, y); False, если она в него не попадает
+        dx = x - self.anchor_x
+        dy = y - self.anchor_y
+        distance = math.hypot(dx, dy)
+        if distance + self.epsilon < self.reach:
+            return False
+        if distance > self.epsilon:
+            angle = math.atan2(dy, dx)
+            if self.reference is None:
+                self.reference = angle
+            angle = (angle - self.reference + math.pi) % (2 * math.pi) - math.pi
+            if not self.low <= angle <= self.high:
+                return False
+            half = math.asin(self.epsilon / distance)
+            self.low = max(self.low, angle - half)
+            self.high = min(self.high, angle + half)
+        self.reach = max(self.reach, distance)
+        return True
+
+    def add(self, x, y):
+        # True - точка заменяет временную, False - её нужно дописать
+        if self.last is not None and self.constrain(x, y):
+            self.last = (x, y)
+            return True
+        if self.last is not None:
+            # Временная точка становится окончательной и новым началом отсчёта
+            self.anchor_x, self.anchor_y = self.last
+            self.reset_cone()
+        self.constrain(x, y)
+        self.last = (x, y)
+        return False
+
+
+def simplify_rdp(coords, start, end, epsilon):
+    # Рамер-Дуглас-Пекер для точек [start, end) плоского массива coords.
+    # Возвращает номера сохраняемых точек по возрастанию
+    if end - start < 3:
+        return list(range(start, end))
+    keep = bytearray(end - start)
+    keep[0] = keep[-1] = 1
+    stack = [(start, end - 1)]
+    while stack:
+        first, last = stack.pop()
+        ax, ay = coords[2 * first], coords[2 * first + 1]
+        bx, by = coords[2 * last], coords[2 * last + 1]
+        dx = bx - ax
+        dy = by - ay
+        length2 = dx * dx + dy * dy
+        worst = -1.0
+        worst_index = first
+        for index in range(first + 1, last):
+            # Расстояние до отрезка, а не до прямой: возвраты назад тоже учитываются
+            px = coords[2 * index] - ax
+            py = coords[2 * index + 1] - ay
+            t = 0.0
+            if length2 > 0:
+                t = min(max((px * dx + py * dy) / length2, 0.0), 1.0)
+            distance = math.hypot(px - t * dx, py - t * dy)
+            if distance > worst:
+                worst = distance
+                worst_index = index
+        if worst > epsilon:
+            keep[worst_index - start] = 1
+            if worst_index - first > 1:
+                stack.append((first, worst_index))
+            if last - worst_index > 1:
+                stack.append((worst_index, last))
+    return [start + i for i, flag in enumerate(keep) if flag]
+
+
+def compact_history(offsets, coords, epsilon):
+    # Новые массивы offsets и coords с упрощёнными линиями
+    result_offsets = array('Q')
+    result_coords = array('d')
+    point_count = len(coords) // 2
+    for index in range(len(offsets)):
+        start = offsets[index]
+        end = offsets[index + 1] if index + 1 < len(offsets) else point_count
+        result_offsets.append(len(result_coords) // 2)
+        for point in simplify_rdp(coords, start, end, epsilon):
+            result_coords.append(coords[2 * point])
+            result_coords.append(coords[2 * point + 1])
+    return result_offsets, result_coords
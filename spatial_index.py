@@ -0,0 +1,118 @@
+import math
+from array import array
+
+
+def segment_hits_rect(ax, ay, bx, by, x0, y0, x1, y1):
+    # Пересекает ли отрезок прямоугольник (x0 <= x1, y0 <= y1): отсечение
+    # по сторонам методом Лианга-Барски
+    t0, t1 = 0.0, 1.0
+    dx = bx - ax
+    dy = by - ay
+    for p, q in ((-dx, ax - x0), (dx, x1 - ax), (-dy, ay - y0), (dy, y1 - ay)):
+        if p == 0:
+            if q < 0:
+                return False
+            continue
+        t = q / p
+        if p < 0:
+            if t > t1:
+                return False
+            t0 = max(t0, t)
+        else:
+            if t < t0:
+                return False
+            t1 = min(t1, t)
+    return True
+
+
+class SpatialIndex:
+    # Равномерная сетка над отрезками истории. Отрезок с номером p соединяет
+    # точки p - 1 и p (для первой точки линии - вырожденный, из одной точки)
+    # и записывается в ячейки, через которые проходит: после упрощения
+    # отрезки длинные, и габарит диагонали занимал бы тысячи ячеек
+    def __init__(self, cell_size=8.0):
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def __len__(self):
+        return len(self.cells)
+
+    def cell(self, x, y):
+        return math.floor(x / self.cell_size), math.floor(y / self.cell_size)
+
+    def add(self, index, x0, y0, x1, y1):
+        for key in self.segment_cells(x0, y0, x1, y1):
+            bucket = self.cells.get(key)
+            if bucket is None:
+                bucket = self.cells[key] = array('Q')
+            bucket.append(index)
+
+    def segment_cells(self, x0, y0, x1, y1):
+        # Ячейки вдоль отрезка (обход сетки Amanatides-Woo): каждый шаг - в
+        # соседнюю по x или y ячейку, где отрезок раньше пересекает границу
+        size = self.cell_size
+        cx, cy = self.cell(x0, y0)
+        end_x, end_y = self.cell(x1, y1)
+        yield cx, cy
+        dx = x1 - x0
+        dy = y1 - y0
+        step_x = 1 if dx > 0 else -1
+        step_y = 1 if dy > 0 else -1
+        delta_x = size / abs(dx) if dx else math.inf
+        delta_y = size / abs(dy) if dy else math.inf
+        next_x = ((cx + (dx > 0)) * size - x0) / dx if dx else math.inf
+        next_y = ((cy + (dy > 0)) * size - y0) / dy if dy else math.inf
+        for _ in range(abs(end_x - cx) + abs(end_y - cy)):
+            # Погрешность округления не уводит за конечную ячейку
+            if cy == end_y or (cx != end_x and next_x < next_y):
+                cx += step_x
+                next_x += delta_x
+            else:
+                cy += step_y
+                next_y += delta_y
+            yield cx, cy
+
+    def clear(self):
+        self.cells = {}
+
+    def rebuild(self, store):
+        # Полная перестройка по StrokeStore (после загрузки истории)
+        self.clear()
+        coords = store.coords
+        starts = set(store.offsets)
+        size = self.cell_size
+        cells = self.cells
+        prev_x = prev_y = 0.0
+        for index in range(store.point_count):
+            x = coords[2 * index]
+            y = coords[2 * index + 1]
+            if index in starts:
+                prev_x, prev_y = x, y
+            cx = math.floor(x / size)
+            cy = math.floor(y / size)
+            if cx == math.floor(prev_x / size) and cy == math.floor(prev_y / size):
+                bucket = cells.get((cx, cy))
+                if bucket is None:
+                    bucket = cells[(cx, cy)] = array('Q')
+                bucket.append(index)
+            else:
+                self.add(index, prev_x, prev_y, x, y)
+            prev_x, prev_y = x, y
+
+    def query(self, x0, y0, x1, y1):
+        # Номера отрезков из ячеек, пересекающих прямоугольник (с запасом)
+        cx0, cy0 = self.cell(x0, y0)
+        cx1, cy1 = self.cell(x1, y1)
+        result = set()
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(self.cells):
+            # Прямоугольник больше занятой области: обходим только занятые ячейки
+            for (cx, cy), bucket in self.cells.items():
+                if cx0 <= cx <= cx1 and cy0 <= cy <= cy1:
+                    result.update(bucket)
+        else:
+            for cx in range(cx0, cx1 + 1):
+                for cy in range(cy0, cy1 + 1):
+                    bucket = self.cells.get((cx, cy))
+                    if bucket is not None:
+                        result.update(bucket)
+        return sorted(result)
@@ -0,0 +1,81 @@
+from array import array
+
+
+class StrokeStore:
+    # Линии хранятся в одном непрерывном массиве координат x0, y0, x1, y1, ...
+    # offsets[i] - индекс первой точки i-й линии
+    def __init__(self):
+        self.coords = array('d')
+        self.offsets = array('Q')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        for index in range(len(self.offsets)):
+            yield self.stroke_points(index)
+
+    @property
+    def point_count(self):
+        return len(self.coords) // 2
+
+    @property
+    def nbytes(self):
+        return (len(self.coords) * self.coords.itemsize
+                + len(self.offsets) * self.offsets.itemsize)
+
+    def begin_stroke(self, x, y):
+        self.offsets.append(self.point_count)
+        self.coords.append(x)
+        self.coords.append(y)
+
+    def append(self, x, y):
+        self.coords.append(x)
+        self.coords.append(y)
+
+    def replace_last(self, x, y):
+        self.coords[-2] = x
+        self.coords[-1] = y
+
+    def clear(self):
+        self.coords = array('d')
+        self.offsets = array('Q')
+
+    def load(self, offsets, coords):
+        # Замена содержимого готовыми массивами (снимок, файл SAVE)
+        self.offsets = offsets
+        self.coords = coords
+
+    def write_offsets(self, first, offsets):
+        # Начала линий с номера first; всё, что было дальше, отбрасывается
+        del self.offsets[first:]
+        self.offsets.extend(offsets)
+
+    def write_coords(self, first, coords):
+        # Точки с номера first; всё, что было дальше, отбрасывается
+        del self.coords[2 * first:]
+        self.coords.extend(coords)
+
+    def stroke_range(self, index):
+        start = self.offsets[index]
+        if index + 1 < len(self.offsets):
+            end = self.offsets[index + 1]
+        else:
+            end = self.point_count
+        return start, end
+
+    def coords_slice(self, start, end):
+        # Копия координат точек [start, end) в виде плоского массива
+        # (обновления хранятся для RESYNC дольше, чем держится блокировка)
+        return self.coords[2 * start:2 * end]
+
+    def points(self, start, end):
+        # Точки [start, end) в виде списка пар для JSON
+        coords = self.coords[2 * start:2 * end]
+        return [[coords[i], coords[i + 1]] for i in range(0, len(coords), 2)]
+
+    def stroke_points(self, index):
+        return self.points(*self.stroke_range(index))
+
+    def to_list(self):
+        return list(self)
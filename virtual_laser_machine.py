@@ -1,16 +1,197 @@
+import math
+from bisect import bisect_right
+from stroke_store import StrokeStore
+from spatial_index import SpatialIndex, segment_hits_rect
+from simplify import StrokeSimplifier, DEFAULT_EPSILON
+
+
 class VirtualLaserMachine:
-    def __init__(self):
+    STATE_FIELDS = ('x', 'y', 'laser_on', 'speed', 'job')
+
+    def __init__(self, epsilon=DEFAULT_EPSILON):
         self.x = 0.0
         self.y = 0.0
         self.laser_on = False
         self.speed = 100.0  # Шагов в секунду
-        self.history = []   # Хранит списки точек для каждой линии [[(x1,y1), (x2,y2)], ...]
+        self.history = StrokeStore()  # Точки всех линий в компактных массивах
+        self.index = SpatialIndex()   # Отрезки истории по ячейкам сетки
+        # Точки записываются с упрощением: последняя точка текущей линии
+        # временная и может быть заменена следующей (см. StrokeSimplifier)
+        self.simplifier = StrokeSimplifier(epsilon)
+        self._provisional = None  # Номер временной точки
+        self.revision = 0         # Растёт при каждом изменении истории
+        self.job = None     # Прогресс задания: {'state', 'done', 'total'}
+
+        # Состояние потока обновлений: что уже отправлено клиентам
+        self.seq = 0
+        self._sent = {}
+        self._sent_strokes = 0  # Количество линий, известных клиентам
+        self._sent_points = 0   # Общее количество отправленных точек
+        self._sent_revision = 0
+        self._cleared = False
+        self.clears = 0  # Счётчик очисток истории (для журнала)
+
+    def get_state(self):
+        state = {'type': 'state', 'seq': self.seq}
+        for key in self.STATE_FIELDS:
+            state[key] = getattr(self, key)
+        return state
 
     def get_status(self):
-        return {
-            'x': self.x,
-            'y': self.y,
-            'laser_on': self.laser_on,
-            'speed': self.speed,
-            'history': self.history.copy()
-        }
\ No newline at end of file
+        status = self.get_state()
+        status['type'] = 'status'
+        status['history'] = self.history.to_list()
+        return status
+
+    @property
+    def committed_points(self):
+        # Точки до этого номера уже не изменятся
+        if self._provisional is None:
+            return self.history.point_count
+        return self._provisional
+
+    def commit(self):
+        # Временная точка становится окончательной и попадает в индекс
+        index = self._provisional
+        if index is not None:
+            coords = self.history.coords
+            self.index.add(index, coords[2 * index - 2], coords[2 * index - 1],
+                           coords[2 * index], coords[2 * index + 1])
+            self._provisional = None
+
+    def begin_stroke(self, x, y):
+        self.commit()
+        self.index.add(self.history.point_count, x, y, x, y)
+        self.history.begin_stroke(x, y)
+        self.simplifier.begin(x, y)
+        self.revision += 1
+
+    def add_point(self, x, y):
+        # После CLEAR во время резки точка начинает новую линию
+        history = self.history
+        if not len(history):
+            self.begin_stroke(x, y)
+            return
+        if self.simplifier.add(x, y):
+            history.replace_last(x, y)
+        else:
+            self.commit()
+            self._provisional = history.point_count
+            history.append(x, y)
+        self.revision += 1
+
+    def add_points(self, coords):
+        # Сегмент целиком (аналитический режим часов); каждая точка проходит
+        # через упрощение, как при пошаговом движении
+        for i in range(0, len(coords), 2):
+            self.add_point(coords[i], coords[i + 1])
+
+    def clear(self):
+        self.history.clear()
+        self.index.clear()
+        self._provisional = None
+        self.revision += 1
+        self.clears += 1
+        self._cleared = True
+        self._sent_strokes = 0
+        self._sent_points = 0
+
+    def restore(self, offsets, coords, state):
+        # Замена истории загруженной; клиенты получат её после очистки
+        self.clear()
+        self.history.load(offsets, coords)
+        self.x, self.y, self.speed, self.laser_on = state
+        self.reindex()
+
+    def reindex(self):
+        # Производные структуры после замены истории целиком: индекс и
+        # упрощение, продолжающее последнюю линию от её последней точки
+        self.index.rebuild(self.history)
+        self._provisional = None
+        self.revision += 1
+        history = self.history
+        if history.point_count:
+            coords = history.coords
+            self.simplifier.begin(coords[-2], coords[-1])
+
+    def query_region(self, x0, y0, x1, y1, max_points=None):
+        # Участки линий, задевающие прямоугольник; при max_points точки
+        # прореживаются равномерно, концы участков сохраняются
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+        history = self.history
+        coords = history.coords
+        offsets = history.offsets
+
+        candidates = self.index.query(x0, y0, x1, y1)
+        if self._provisional is not None:
+            # Временный отрезок в индекс ещё не записан
+            candidates.append(self._provisional)
+        runs = []  # [номер линии, первая точка, последняя точка]
+        for index in candidates:
+            stroke = bisect_right(offsets, index) - 1
+            first = index if offsets[stroke] == index else index - 1
+            ax, ay = coords[2 * first], coords[2 * first + 1]
+            bx, by = coords[2 * index], coords[2 * index + 1]
+            if not segment_hits_rect(ax, ay, bx, by, x0, y0, x1, y1):
+                continue
+            if runs and runs[-1][0] == stroke and runs[-1][2] >= first:
+                runs[-1][2] = index
+            else:
+                runs.append([stroke, first, index])
+
+        total = sum(last - first + 1 for _, first, last in runs)
+        step = 1
+        if max_points and total > max_points:
+            step = math.ceil(total / max_points)
+        strokes = []
+        for stroke, first, last in runs:
+            points = history.points(first, last + 1)
+            if step > 1:
+                points = points[:-1:step] + points[-1:]
+            strokes.append([stroke, points])
+        return {'type': 'history_query', 'seq': self.seq, 'total': total, 'strokes': strokes}
+
+    def take_delta(self):
+        # Собирает изменения с момента предыдущего вызова; None, если их нет.
+        # Вызывается под блокировкой станка, как Journal.collect
+        delta = {}
+        for key in self.STATE_FIELDS:
+            value = getattr(self, key)
+            if self._sent.get(key) != value:
+                delta[key] = value
+                self._sent[key] = value
+
+        # Временная точка отправляется, но считается неотправленной: если её
+        # заменят, следующее обновление перепишет линию начиная с неё.
+        # Каждая запись линии: [номер, позиция первой точки в линии, координаты]
+        strokes = []
+        history = self.history
+        if self.revision != self._sent_revision:
+            self._sent_revision = self.revision
+            committed = self.committed_points
+            stroke_count = len(history)
+            point_count = history.point_count
+            sent_points = self._sent_points
+            for index in range(max(self._sent_strokes - 1, 0), stroke_count):
+                start, end = history.stroke_range(index)
+                first = max(start, self._sent_points)
+                end = min(end, point_count)
+                if end > first:
+                    strokes.append([index, first - start, history.coords_slice(first, end)])
+                sent_points = max(sent_points, end)
+            self._sent_strokes = stroke_count
+            self._sent_points = min(sent_points, committed)
+
+        if not delta and not strokes and not self._cleared:
+            return None
+
+        self.seq += 1
+        delta['type'] = 'delta'
+        delta['seq'] = self.seq
+        if self._cleared:
+            delta['clear'] = True
+            self._cleared = False
+        if strokes:
+            delta['strokes'] = strokes
+        return delta